@@ -1,12 +1,21 @@
-import docker
 from docker.errors import DockerException
 
 from . import aflcov, casr, fuzzer_state, vulnerability_detection_time
-from .build import build_fuzzer, build_image, build_images, build_target
-from .deploy import fuzzing
+from .backend import DockerHost, ProcessHost, TmpfsOutput
+from .build import build_fuzzer, build_image, build_images, build_target, gc_images
+from .cpu import AllocationPolicy, CpuAllocator
+from .deploy import extend, fuzzing
+from .jobs import FuzzingJob
+from .logcap import LogPolicy
+from .memory import MemoryPolicy
+from .session import get_session
+from .sources import SourceCache
+from .stopping import StopRule
+from .triage import TriageCache
 from .utils import work_dir_iterdir
 
 try:
-    docker.from_env().ping()
+    get_session().client.ping()
 except DockerException:
-    assert False, "Is docker running properly?"
+    # ProcessHost runs do not need docker
+    print("Is docker running properly? Only ProcessHost can be used.")
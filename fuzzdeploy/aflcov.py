@@ -2,8 +2,16 @@ from pathlib import Path
 
 import pandas as pd
 
+from .dispatch import Host
 from .make import make
-from .utils import WorkDirItem, get_item_path, hash_path, work_dir_iterdir
+from .memory import MemoryPolicy
+from .utils import (
+    WorkDirItem,
+    get_item_path,
+    get_item_paths,
+    hash_path,
+    work_dir_iterdir,
+)
 
 
 def _skip_handler(item: WorkDirItem) -> bool:
@@ -23,13 +31,30 @@ def _skip_handler(item: WorkDirItem) -> bool:
     return False
 
 
-def get(work_dir: str | Path):
+def _work_handler(item: WorkDirItem) -> int:
+    return sum(
+        len([p for p in queue_path.glob("id*") if p.is_file()])
+        for queue_path in get_item_paths(item.path, "queue")
+    )
+
+
+def get(
+    work_dir: str | Path,
+    *,
+    hosts: list[Host] | None = None,
+    memory: MemoryPolicy | None = None,
+    pool: bool = False,
+):
     work_dir = Path(work_dir).absolute()
     make(
         work_dir=work_dir,
         sub_dir="aflcov",
         base_image="aflcov",
         skip_handler=_skip_handler,
+        work_handler=_work_handler,
+        hosts=hosts,
+        memory=memory,
+        pool=pool,
     )
     res_ls = []
     for item in work_dir_iterdir(work_dir, "aflcov"):
@@ -0,0 +1,391 @@
+import io
+import os
+import shutil
+import signal
+import subprocess
+import tarfile
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+from typing import NamedTuple
+
+from docker.models.containers import Container
+
+from .build import get_runtime_hash
+from .cpu import CpuAllocator, get_cpu_slots, parse_cpu_list
+from .scheduler import ContainerScheduler, SlotScheduler
+from .session import get_session
+from .utils import get_runtime_image_name, get_target_image_name, size_to_bytes
+
+ARCHIVE_DIR = "/archive"
+TMPFS_ROOT = Path("/dev/shm")
+
+
+class TmpfsOutput(NamedTuple):
+    # cap of the in-memory output dir of one run
+    size: str = "1g"
+    # seconds between two syncs of the output to the archive
+    interval: int = 300
+    # seconds a stopped run gets for the final sync before it is killed
+    stop_timeout: int = 300
+
+
+class RunSpec(NamedTuple):
+    name: str
+    # the image is <fuzzer>:<target>, see utils.get_target_image_name
+    fuzzer: str
+    target: str
+    # host file that runs as ${SRC}/script.sh
+    script: Path
+    cpuset: str
+    # path inside the image -> host path, usually /shared
+    volumes: dict[str, Path]
+    environment: dict[str, str]
+    labels: dict[str, str]
+    timeout: str | None = None
+    # hard memory limit in bytes, only docker can enforce it
+    mem_limit: int | None = None
+    # write /shared into memory, see start.sh for the sync to the archive
+    tmpfs: TmpfsOutput | None = None
+    # run in the slim runtime image when it is current, only start.sh of a
+    # fuzzing run can do without the full image
+    runtime: bool = False
+
+
+def get_mounts(spec: RunSpec) -> tuple[dict[str, Path], dict[str, str]]:
+    # with tmpfs the host path of /shared is mounted at /archive instead
+    if spec.tmpfs is None:
+        return spec.volumes, spec.environment
+    volumes = dict(spec.volumes)
+    volumes[ARCHIVE_DIR] = volumes.pop("/shared")
+    environment = {
+        **spec.environment,
+        "ARCHIVE": ARCHIVE_DIR,
+        "SYNC_INTERVAL": str(spec.tmpfs.interval),
+    }
+    return volumes, environment
+
+
+class DockerHost(NamedTuple):
+    # DOCKER_HOST style url, None for the daemon configured in the environment
+    url: str | None = None
+    cpu_range: (list[str | int] | set[str | int] | CpuAllocator) | None = None
+    # whether the daemon sees the work_dir at the same path, so that run
+    # outputs can be bind mounted instead of being copied back at the end
+    shared_fs: bool | None = None
+
+    @property
+    def name(self) -> str:
+        return self.url or "local"
+
+    @property
+    def is_shared_fs(self) -> bool:
+        if self.shared_fs is not None:
+            return self.shared_fs
+        return self.url is None
+
+    def get_backend(self, **kwargs) -> "DockerBackend":
+        return DockerBackend(self, **kwargs)
+
+
+class ProcessHost(NamedTuple):
+    # native builds laid out like the images,
+    # <native_dir>/<fuzzer>/<target>/{src/fuzzer,src/target,program}
+    native_dir: str | Path
+    cpu_range: (list[str | int] | set[str | int] | CpuAllocator) | None = None
+
+    @property
+    def name(self) -> str:
+        return "native"
+
+    @property
+    def is_shared_fs(self) -> bool:
+        return True
+
+    def get_backend(self, **kwargs) -> "ProcessBackend":
+        return ProcessBackend(self, **kwargs)
+
+
+def get_volume_name(container_name: str) -> str:
+    return f"fuzzdeploy-{container_name}"
+
+
+def put_file(container: Container, src: str | Path, dst_dir: str, dst_name: str):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        tarinfo = tar.gettarinfo(str(src), arcname=dst_name)
+        tarinfo.uid, tarinfo.gid = os.getuid(), os.getgid()
+        with open(src, "rb") as f:
+            tar.addfile(tarinfo, f)
+    container.put_archive(dst_dir, data.getvalue())
+
+
+def put_dir(container: Container, src: str | Path, dst_dir: str):
+    with tempfile.TemporaryFile() as f:
+        with tarfile.open(fileobj=f, mode="w") as tar:
+            for p in Path(src).iterdir():
+                tar.add(p, arcname=p.name)
+        f.seek(0)
+        container.put_archive(dst_dir, f)
+
+
+def get_dir(container: Container, src_dir: str, dst: str | Path):
+    dst = Path(dst)
+    dst.mkdir(parents=True, exist_ok=True)
+    bits, _ = container.get_archive(src_dir)
+    with tempfile.TemporaryFile() as f:
+        for chunk in bits:
+            f.write(chunk)
+        f.seek(0)
+        with tarfile.open(fileobj=f, mode="r") as tar:
+            members = []
+            for member in tar.getmembers():
+                # strip the leading src_dir name of every member
+                parts = Path(member.name).parts[1:]
+                if not parts or ".." in parts or member.issym() or member.islnk():
+                    continue
+                member.name = Path(*parts).as_posix()
+                members.append(member)
+            tar.extractall(dst, members=members)
+
+
+class DockerBackend(ContainerScheduler):
+    def __init__(self, host: DockerHost, **kwargs):
+        session = get_session(host.url)
+        super().__init__(session, get_cpu_slots(host.cpu_range, session.ncpu), **kwargs)
+        self.host = host
+        # container id -> (output dir in the container, path on the central
+        # host), for remote runs
+        self.sync_paths: dict[str, tuple[str, Path]] = {}
+
+    def is_image_exist(self, fuzzer: str, target: str) -> bool:
+        return self.session.is_image_exist(get_target_image_name(fuzzer, target))
+
+    def get_image_name(self, fuzzer: str, target: str) -> str:
+        # the slim runtime image if it was built from the current target image
+        image_name = get_target_image_name(fuzzer, target)
+        runtime_image_name = get_runtime_image_name(fuzzer, target)
+        if not self.session.is_image_exist(runtime_image_name):
+            return image_name
+        runtime_hash = get_runtime_hash(self.session.get_image_hash(image_name))
+        if self.session.get_image_hash(runtime_image_name) != runtime_hash:
+            return image_name
+        return runtime_image_name
+
+    def launch(self, spec: RunSpec, *, resume: bool = False) -> Container:
+        if spec.timeout:
+            command = f"-c 'timeout {spec.timeout} ${{SRC}}/script.sh'"
+        else:
+            command = f"-c '${{SRC}}/script.sh'"
+        volumes, environment = get_mounts(spec)
+        container_args = {
+            "image": (
+                self.get_image_name(spec.fuzzer, spec.target)
+                if spec.runtime
+                else get_target_image_name(spec.fuzzer, spec.target)
+            ),
+            "command": command,
+            "cap_add": ["SYS_PTRACE"],
+            "cpuset_cpus": spec.cpuset,
+            "detach": True,
+            "name": spec.name,
+            "network_mode": "none",
+            "privileged": True,
+            "tty": True,
+            "security_opt": ["seccomp=unconfined"],
+            "environment": environment,
+            "labels": spec.labels,
+            "user": f"{os.getuid()}:{os.getgid()}",
+        }
+        if spec.mem_limit:
+            # no swap either, a run over its limit is killed instead
+            container_args["mem_limit"] = spec.mem_limit
+            container_args["memswap_limit"] = spec.mem_limit
+        if spec.tmpfs is not None:
+            container_args["tmpfs"] = {
+                "/shared": f"size={size_to_bytes(spec.tmpfs.size)},mode=1777"
+            }
+        if resume:
+            self.session.remove_stale_container(spec.name)
+        if self.host.is_shared_fs:
+            binds = {
+                host_path.as_posix(): {"bind": path, "mode": "rw"}
+                for path, host_path in volumes.items()
+            }
+            binds[spec.script.as_posix()] = {"bind": "/src/script.sh", "mode": "ro"}
+            return self.session.run_container(**container_args, volumes=binds)
+        # the remote daemon can not see our files, the run writes into
+        # a volume on its host that is copied back when the run ends
+        assert len(volumes) == 1, f"{self.host.name} can only mount /shared"
+        output_dir, host_path = next(iter(volumes.items()))
+        volume_name = get_volume_name(spec.name)
+        self.session.remove_stale_volume(volume_name)
+        container = self.session.create_container(
+            **container_args,
+            volumes={volume_name: {"bind": output_dir, "mode": "rw"}},
+        )
+        put_file(container, spec.script, "/src", "script.sh")
+        if resume:
+            put_dir(container, host_path, output_dir)
+        container.start()
+        self.sync_paths[container.id] = (output_dir, host_path)  # type: ignore
+        return container
+
+    def _before_release(self, container: Container):
+        if container.id in self.sync_paths:
+            self.sync_back(container)
+
+    def sync_back(self, container: Container):
+        # copy the output of a finished remote run into the central archive
+        output_dir, host_path = self.sync_paths.pop(container.id)  # type: ignore
+        get_dir(container, output_dir, host_path)
+        self.session.remove_container(container, force=True)
+        self.session.remove_stale_volume(get_volume_name(container.name))  # type: ignore
+
+    def stop(self):
+        for container in list(self.containers.values()):
+            self._stop(container)
+            if container.id in self.sync_paths:
+                self.sync_back(container)
+        super().stop()
+
+
+def _get_session_pids(sid: int) -> list[int]:
+    pids = []
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            stat = stat_path.read_text()
+        except OSError:
+            continue
+        # the comm field may contain spaces, the fields after it do not
+        fields = stat[stat.rindex(")") + 2 :].split()
+        if int(fields[3]) == sid:
+            pids.append(int(stat_path.parent.name))
+    return pids
+
+
+class ProcessRun:
+    def __init__(
+        self,
+        name: str,
+        labels: dict[str, str],
+        process: subprocess.Popen,
+        tmp_dir: Path | None = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.short_id = str(process.pid)
+        self.name = name
+        self.labels = labels
+        self.process = process
+        self.tmp_dir = tmp_dir
+
+    @property
+    def status(self) -> str:
+        return "running" if self.process.poll() is None else "exited"
+
+    def reload(self):
+        pass
+
+    def stop(self, timeout: int = 10):
+        if self.process.poll() is not None:
+            return
+        # the run is started in its own session, so this reaches the fuzzer too
+        os.killpg(self.process.pid, signal.SIGTERM)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+
+
+class ProcessBackend(SlotScheduler):
+    def __init__(self, host: ProcessHost, **kwargs):
+        super().__init__(get_cpu_slots(host.cpu_range, os.cpu_count() or 1), **kwargs)
+        self.host = host
+        self.native_dir = Path(host.native_dir).absolute()
+        self.containers: dict[str, ProcessRun] = {}
+
+    def is_image_exist(self, fuzzer: str, target: str) -> bool:
+        return (self.native_dir / fuzzer / target / "program").exists()
+
+    def launch(self, spec: RunSpec, *, resume: bool = False) -> ProcessRun:
+        root = self.native_dir / spec.fuzzer / spec.target
+        src = root / "src"
+        volumes, spec_environment = get_mounts(spec)
+        tmp_dir = None
+        if spec.tmpfs is not None:
+            # /dev/shm is a tmpfs already, but its size can not be capped per run
+            tmp_dir = TMPFS_ROOT / f"fuzzdeploy-{spec.name}"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            tmp_dir.mkdir(parents=True)
+            volumes["/shared"] = tmp_dir
+        environment = {
+            **os.environ,
+            "SRC": src.as_posix(),
+            "FUZZER": (src / "fuzzer").as_posix(),
+            "TARGET": (src / "target").as_posix(),
+            "PROGRAM": (root / "program").as_posix(),
+            "FUZZER_NAME": spec.fuzzer,
+            "TARGET_NAME": spec.target,
+        }
+        if "/shared" in volumes:
+            environment["SHARED"] = volumes["/shared"].as_posix()
+        # variables that point into a mount point at the host path instead
+        for key, value in spec_environment.items():
+            environment[key] = volumes[value].as_posix() if value in volumes else value
+        args = ["bash", spec.script.as_posix()]
+        if spec.timeout:
+            args = ["timeout", spec.timeout] + args
+        # pinned before the first instruction of the run, every process it
+        # forks inherits the cpus
+        args = ["taskset", "-c", spec.cpuset] + args
+        process = subprocess.Popen(
+            args,
+            # workers of make(pool=True) have no /shared of their own
+            cwd=volumes.get("/shared", root),
+            env=environment,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        run = ProcessRun(spec.name, spec.labels, process, tmp_dir)
+        threading.Thread(target=self._watch, args=(run,), daemon=True).start()
+        return run
+
+    def _watch(self, run: ProcessRun):
+        run.process.wait()
+        self._exited.put(run.id)
+
+    def _remove(self, container: ProcessRun):
+        if container.tmp_dir is not None:
+            shutil.rmtree(container.tmp_dir, ignore_errors=True)
+
+    def _reconcile(self):
+        for run_id, run in list(self.containers.items()):
+            if run.status == "exited":
+                self._exited.put(run_id)
+
+    def get_memory_total(self) -> int | None:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+    def get_memory_usage(self, container: ProcessRun) -> int | None:
+        usage = 0
+        for pid in _get_session_pids(container.process.pid):
+            try:
+                status = Path(f"/proc/{pid}/status").read_text()
+            except OSError:
+                continue
+            for line in status.splitlines():
+                if line.startswith("VmRSS:"):
+                    usage += int(line.split()[1]) * 1024
+        return usage
+
+    def update_cpuset(self, container: ProcessRun, cpuset: str):
+        cpus = parse_cpu_list(cpuset)
+        for pid in _get_session_pids(container.process.pid):
+            try:
+                os.sched_setaffinity(pid, cpus)
+            except OSError:
+                pass
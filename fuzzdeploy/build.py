@@ -1,15 +1,28 @@
+import hashlib
+import io
 import multiprocessing
 import os
-import shutil
+import queue
+import re
+import subprocess
+import tarfile
 import tempfile
 from datetime import datetime
 from enum import Enum
-from pathlib import Path
-from typing import NamedTuple
+from fnmatch import fnmatch
+from pathlib import Path, PurePosixPath
+from typing import Iterator, NamedTuple
 
-import docker
-
-from .utils import get_fuzzer_image_name, get_target_image_name, is_image_exist
+from .logcap import LogPolicy, LogWriter
+from .session import HASH_LABEL, get_session
+from .sources import SourceCache, get_source
+from .utils import (
+    get_fuzzer_image_name,
+    get_runtime_image_name,
+    get_target_image_name,
+    is_image_exist,
+    size_to_bytes,
+)
 
 
 class BuildStatus(Enum):
@@ -21,10 +34,30 @@ class BuildStatus(Enum):
     TARGET_IMAGE_NOT_EXISTENCE = "target image not existence"
     FUZZER_BUILD_SUCCESS = "fuzzer build success"
     TARGET_BUILD_SUCCESS = "target build success"
+    RUNTIME_BUILD_FAILURE = "runtime build failure"
+    RUNTIME_IMAGE_EXISTENCE = "runtime image existence"
+    RUNTIME_BUILD_SUCCESS = "runtime build success"
+    SOURCE_FETCH_FAILURE = "source fetch failure"
 
 
 TOP_DIR = Path(__file__).resolve().parent.parent
 NOW = datetime.now().strftime("%Y%m%d%H%M")
+# left out of a build context, "/" anchors a pattern at the fuzzer or target
+# dir: the sources fetch.sh leaves in a local checkout, backups and outputs
+CONTEXT_IGNORE = ["/repo", "*.bak", "*.o", "*.pyc", "__pycache__", ".git"]
+# the seeds are no input of the build
+HASH_IGNORE = CONTEXT_IGNORE + ["/corpus"]
+# name of the Dockerfile in a build context
+CONTEXT_DOCKERFILE = ".dockerfile"
+# keeps the Dockerfile out of "COPY . ${SRC}/" and its layer cache, docker
+# still reads both files
+CONTEXT_DOCKERIGNORE = f"{CONTEXT_DOCKERFILE}\n.dockerignore\n".encode()
+# printed by Dockerfile_target_ccache
+CCACHE_STATS = re.compile(r"FUZZDEPLOY_CCACHE hits=(\d*) misses=(\d*)")
+# a build context larger than that is spooled to disk
+CONTEXT_SPOOL_SIZE = 64 * 1024**2
+# the base images of make(), their scripts need the full target image
+MAKE_FUZZERS = ("aflcov", "casr")
 
 
 class BuildImageResult(NamedTuple):
@@ -34,20 +67,188 @@ class BuildImageResult(NamedTuple):
     code: int
     status: BuildStatus
     log_path: str | None
+    # whether an image built from the same inputs was found
+    cache_hit: bool = False
+    # compilations served from and missed by ccache, with ccache only
+    ccache_hits: int | None = None
+    ccache_misses: int | None = None
 
 
 def remove_image(image_name: str):
-    client = docker.from_env()
-    try:
-        client.images.remove(image_name, force=True)
-    except:
-        pass
+    get_session().remove_image(image_name)
+
+
+def _is_ignored(rel_path: PurePosixPath, ignore: list[str]) -> bool:
+    for pattern in ignore:
+        if pattern.startswith("/"):
+            if rel_path.as_posix() == pattern[1:]:
+                return True
+        elif fnmatch(rel_path.name, pattern):
+            return True
+    return False
+
+
+def iter_context(
+    path: Path, ignore: list[str] = CONTEXT_IGNORE, root: Path | None = None
+) -> Iterator[Path]:
+    # sorted, a dir comes before its content
+    root = root or path
+    for child in sorted(path.iterdir()):
+        if _is_ignored(PurePosixPath(child.relative_to(root)), ignore):
+            continue
+        yield child
+        if child.is_dir() and not child.is_symlink():
+            yield from iter_context(child, ignore, root)
+
+
+def get_file_digest(path: Path) -> bytes:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def _update_hash(h, path: Path, root: Path):
+    h.update(path.relative_to(root).as_posix().encode() + b"\0")
+    if path.is_symlink():
+        h.update(b"l" + os.readlink(path).encode())
+    elif path.is_file():
+        h.update(b"x" if os.access(path, os.X_OK) else b"f")
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    h.update(b"\0")
+
+
+def get_dir_hash(path: Path, *extra: str | Path) -> str:
+    h = hashlib.sha256()
+    for item in extra:
+        if isinstance(item, Path):
+            _update_hash(h, item, item.parent)
+        else:
+            h.update(item.encode() + b"\0")
+    for item_path in iter_context(path, HASH_IGNORE):
+        if item_path.is_symlink() or item_path.is_file():
+            _update_hash(h, item_path, path)
+    return h.hexdigest()
+
+
+def get_context(src: Path, name: str, dockerfile: Path, repo: Path | None = None):
+    # the context is streamed to the daemon as is, without a copy of src
+    context = tempfile.SpooledTemporaryFile(max_size=CONTEXT_SPOOL_SIZE)
+    # files of the same content and mode, e.g. seeds that are shared between
+    # the corpus dirs, are stored once and hard linked
+    stored: dict[tuple[bytes, int], str] = {}
+    with tarfile.open(fileobj=context, mode="w") as tar:
+        tar.add(dockerfile, arcname=CONTEXT_DOCKERFILE)
+        info = tarfile.TarInfo(".dockerignore")
+        info.size = len(CONTEXT_DOCKERIGNORE)
+        tar.addfile(info, io.BytesIO(CONTEXT_DOCKERIGNORE))
+        items = [(path, path.relative_to(src)) for path in iter_context(src)]
+        if repo is not None:
+            # a cached source takes the place of the one fetch.sh would fetch
+            items.append((repo, Path("repo")))
+            items += [
+                (path, "repo" / path.relative_to(repo))
+                for path in iter_context(repo, [])
+            ]
+        for path, rel_path in items:
+            info = tar.gettarinfo(path, f"{name}/{rel_path.as_posix()}")
+            if not info.isreg():
+                tar.addfile(info)
+                continue
+            key = (get_file_digest(path), info.mode)
+            if key in stored:
+                info.type = tarfile.LNKTYPE
+                info.linkname = stored[key]
+                info.size = 0
+                tar.addfile(info)
+                continue
+            stored[key] = info.name
+            with open(path, "rb") as f:
+                tar.addfile(info, f)
+    context.seek(0)
+    return context
+
+
+def get_fuzzer_hash(fuzzer: str) -> str:
+    return get_dir_hash(
+        TOP_DIR / "fuzzers" / fuzzer,
+        TOP_DIR / "fuzzdeploy" / "Dockerfile_fuzzer",
+        f"{os.getuid()}:{os.getgid()}",
+    )
+
+
+def get_target_dockerfile(ccache: bool = False) -> Path:
+    name = "Dockerfile_target_ccache" if ccache else "Dockerfile_target"
+    return TOP_DIR / "fuzzdeploy" / name
+
+
+def get_target_hash(fuzzer: str, target: str, ccache: bool = False) -> str:
+    # a rebuilt fuzzer image invalidates its target images
+    return get_dir_hash(
+        TOP_DIR / "targets" / target,
+        get_target_dockerfile(ccache),
+        get_fuzzer_hash(fuzzer),
+    )
+
+
+def get_runtime_hash(target_hash: str | None) -> str:
+    # a runtime image is stale once its target image was rebuilt
+    h = hashlib.sha256()
+    _update_hash(h, TOP_DIR / "fuzzdeploy" / "Dockerfile_runtime", TOP_DIR)
+    h.update(str(target_hash).encode())
+    return h.hexdigest()
+
+
+def gc_images() -> int:
+    # drop the images that were replaced by a rebuild, returns the bytes freed
+    return get_session().prune_images()
+
+
+def build_with_buildkit(context, tag: str, buildargs: dict, labels: dict):
+    # docker-py only speaks to the classic builder, the cache mounts of
+    # Dockerfile_target_ccache need the BuildKit of the docker cli
+    args = ["docker", "build", "--progress=plain", "-f", CONTEXT_DOCKERFILE, "-t", tag]
+    for key, value in buildargs.items():
+        args += ["--build-arg", f"{key}={value}"]
+    for key, value in labels.items():
+        args += ["--label", f"{key}={value}"]
+    process = subprocess.Popen(
+        args + ["-"],
+        stdin=context,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env={**os.environ, "DOCKER_BUILDKIT": "1"},
+        text=True,
+        errors="replace",
+    )
+    # the same records as the build api yields
+    for line in process.stdout:  # type: ignore
+        yield {"stream": line}
+    if process.wait() != 0:
+        yield {"error": f"docker build exited with {process.returncode}\n"}
+
+
+def get_ccache_stats(log_path: Path) -> tuple[int | None, int | None]:
+    # the last line of the instrument step of Dockerfile_target_ccache
+    hits = misses = None
+    if log_path.exists():
+        with open(log_path, errors="replace") as f:
+            for line in f:
+                match = CCACHE_STATS.search(line)
+                if match:
+                    hits, misses = int(match.group(1) or 0), int(match.group(2) or 0)
+    return hits, misses
 
 
-def write_log(logs, log_path: str | Path):
+def write_log(logs, log_path: str | Path, policy: LogPolicy | None = None):
     is_error = False
     log_path = Path(log_path)
-    with open(log_path, "w") as f:
+    for stale_path in [log_path, *log_path.parent.glob(f"{log_path.name}.*.gz")]:
+        stale_path.unlink(missing_ok=True)
+    with LogWriter(log_path, policy) as f:
         for log in logs:
             try:
                 if log.get("stream"):
@@ -58,6 +259,9 @@ def write_log(logs, log_path: str | Path):
             except FileNotFoundError:
                 pass
     status = "success" if not is_error else "error"
+    # the rotated parts keep the name of the log they belong to
+    for backup in log_path.parent.glob(f"{log_path.name}.*.gz"):
+        backup.rename(backup.with_name(f"{NOW}-{status}-{backup.name}"))
     if log_path.exists():
         log_path = log_path.rename(
             log_path.with_name(f"{NOW}-{status}-{log_path.name}")
@@ -66,11 +270,21 @@ def write_log(logs, log_path: str | Path):
 
 
 def build_fuzzer(
-    fuzzer: str, log_path: str | Path, *, skip_existed_images: bool = True
+    fuzzer: str,
+    log_path: str | Path,
+    *,
+    skip_existed_images: bool = True,
+    sources: SourceCache | None = None,
 ) -> BuildImageResult:
     fuzzer_image = get_fuzzer_image_name(fuzzer)
+    fuzzer_hash = get_fuzzer_hash(fuzzer)
     if is_image_exist(fuzzer_image):
-        if skip_existed_images:
+        # an image of other inputs is rebuilt and replaced in place, gc_images
+        # removes the old one
+        if (
+            skip_existed_images
+            and get_session().get_image_hash(fuzzer_image) == fuzzer_hash
+        ):
             return BuildImageResult(
                 image_name=fuzzer_image,
                 fuzzer=fuzzer,
@@ -78,25 +292,44 @@ def build_fuzzer(
                 code=0,
                 status=BuildStatus.FUZZER_IMAGE_EXISTENCE,
                 log_path=None,
+                cache_hit=True,
             )
-        else:
+        if not skip_existed_images:
             remove_image(fuzzer_image)
     log_path = Path(log_path).absolute()
     log_path.mkdir(parents=True, exist_ok=True)
-    with tempfile.TemporaryDirectory(prefix=f"{fuzzer}-") as ctx_path:
-        ctx_path = Path(ctx_path)
-        shutil.copytree(
-            TOP_DIR / "fuzzers" / fuzzer, ctx_path / "fuzzer", symlinks=True
+    repo = None
+    if sources is not None:
+        fetch_log_path = log_path / f"{fuzzer}-fetch.log"
+        is_fetched, repo = get_source(
+            sources, TOP_DIR / "fuzzers" / fuzzer, "FUZZER", fetch_log_path
         )
-        logs = docker.from_env().api.build(
-            path=ctx_path.as_posix(),
-            dockerfile=(TOP_DIR / "fuzzdeploy" / "Dockerfile_fuzzer").as_posix(),
+        if not is_fetched:
+            return BuildImageResult(
+                image_name=fuzzer_image,
+                fuzzer=fuzzer,
+                target=None,
+                code=1,
+                status=BuildStatus.SOURCE_FETCH_FAILURE,
+                log_path=fetch_log_path.as_posix(),
+            )
+    with get_context(
+        TOP_DIR / "fuzzers" / fuzzer,
+        "fuzzer",
+        TOP_DIR / "fuzzdeploy" / "Dockerfile_fuzzer",
+        repo,
+    ) as context:
+        logs = get_session().client.api.build(
+            fileobj=context,
+            custom_context=True,
+            dockerfile=CONTEXT_DOCKERFILE,
             tag=fuzzer_image,
             buildargs={
                 "fuzzer_name": fuzzer,
                 "USER_ID": str(os.getuid()),
                 "GROUP_ID": str(os.getgid()),
             },
+            labels={HASH_LABEL: fuzzer_hash},
             rm=True,
             decode=True,
         )
@@ -114,6 +347,7 @@ def build_fuzzer(
                 code=1,
                 status=BuildStatus.FUZZER_BUILD_FAILURE,
             )
+    get_session().add_image(fuzzer_image, fuzzer_hash)
     return BuildImageResult(
         **tmp_com_args,
         code=0,
@@ -122,9 +356,16 @@ def build_fuzzer(
 
 
 def build_target(
-    fuzzer: str, target: str, log_path: str | Path, *, skip_existed_images: bool = True
+    fuzzer: str,
+    target: str,
+    log_path: str | Path,
+    *,
+    skip_existed_images: bool = True,
+    sources: SourceCache | None = None,
+    ccache: bool = False,
 ) -> BuildImageResult:
     image = get_target_image_name(fuzzer, target)
+    target_hash = get_target_hash(fuzzer, target, ccache)
     tmp_com_args = {
         "image_name": image,
         "fuzzer": fuzzer,
@@ -132,13 +373,14 @@ def build_target(
         "log_path": None,
     }
     if is_image_exist(image):
-        if skip_existed_images:
+        if skip_existed_images and get_session().get_image_hash(image) == target_hash:
             return BuildImageResult(
                 **tmp_com_args,
                 code=0,
                 status=BuildStatus.TARGET_IMAGE_EXISTENCE,
+                cache_hit=True,
             )
-        else:
+        if not skip_existed_images:
             remove_image(image)
     log_path = Path(log_path).absolute()
     log_path.mkdir(parents=True, exist_ok=True)
@@ -148,60 +390,194 @@ def build_target(
             code=1,
             status=BuildStatus.FUZZER_IMAGE_NOT_EXISTENCE,
         )
-    with tempfile.TemporaryDirectory(prefix=f"{fuzzer}-{target}-") as ctx_dir:
-        ctx_dir = Path(ctx_dir)
-        shutil.copytree(TOP_DIR / "targets" / target, ctx_dir / "target", symlinks=True)
-        logs = docker.from_env().api.build(
-            path=ctx_dir.as_posix(),
-            dockerfile=(TOP_DIR / "fuzzdeploy" / "Dockerfile_target").as_posix(),
+    repo = None
+    if sources is not None:
+        # one fetch of a target serves the images of all fuzzers
+        fetch_log_path = log_path / f"{target}-fetch.log"
+        is_fetched, repo = get_source(
+            sources, TOP_DIR / "targets" / target, "TARGET", fetch_log_path
+        )
+        if not is_fetched:
+            tmp_com_args["log_path"] = fetch_log_path.as_posix()
+            return BuildImageResult(
+                **tmp_com_args,
+                code=1,
+                status=BuildStatus.SOURCE_FETCH_FAILURE,
+            )
+    with get_context(
+        TOP_DIR / "targets" / target,
+        "target",
+        get_target_dockerfile(ccache),
+        repo,
+    ) as context:
+        buildargs = {
+            "fuzzer_name": fuzzer,
+            "target_name": target,
+        }
+        if ccache:
+            logs = build_with_buildkit(
+                context, image, buildargs, {HASH_LABEL: target_hash}
+            )
+        else:
+            logs = get_session().client.api.build(
+                fileobj=context,
+                custom_context=True,
+                dockerfile=CONTEXT_DOCKERFILE,
+                tag=image,
+                buildargs=buildargs,
+                labels={HASH_LABEL: target_hash},
+                rm=True,
+                decode=True,
+            )
+        target_log_path = log_path / f"{fuzzer}_{target}.log"
+        target_log_path, is_error = write_log(logs, target_log_path)
+        tmp_com_args["log_path"] = target_log_path.as_posix()
+        if ccache:
+            ccache_hits, ccache_misses = get_ccache_stats(target_log_path)
+            tmp_com_args["ccache_hits"] = ccache_hits
+            tmp_com_args["ccache_misses"] = ccache_misses
+        if is_error:
+            return BuildImageResult(
+                **tmp_com_args,
+                code=1,
+                status=BuildStatus.TARGET_BUILD_FAILURE,
+            )
+    get_session().add_image(image, target_hash)
+    return BuildImageResult(
+        **tmp_com_args,
+        code=0,
+        status=BuildStatus.TARGET_BUILD_SUCCESS,
+    )
+
+
+def build_runtime(
+    fuzzer: str,
+    target: str,
+    log_path: str | Path,
+    *,
+    skip_existed_images: bool = True,
+) -> BuildImageResult:
+    image = get_runtime_image_name(fuzzer, target)
+    runtime_hash = get_runtime_hash(
+        get_session().get_image_hash(get_target_image_name(fuzzer, target))
+    )
+    tmp_com_args = {
+        "image_name": image,
+        "fuzzer": fuzzer,
+        "target": target,
+        "log_path": None,
+    }
+    if is_image_exist(image):
+        if skip_existed_images and get_session().get_image_hash(image) == runtime_hash:
+            return BuildImageResult(
+                **tmp_com_args,
+                code=0,
+                status=BuildStatus.RUNTIME_IMAGE_EXISTENCE,
+                cache_hit=True,
+            )
+        if not skip_existed_images:
+            remove_image(image)
+    if not is_image_exist(get_target_image_name(fuzzer, target)):
+        return BuildImageResult(
+            **tmp_com_args,
+            code=1,
+            status=BuildStatus.TARGET_IMAGE_NOT_EXISTENCE,
+        )
+    log_path = Path(log_path).absolute()
+    log_path.mkdir(parents=True, exist_ok=True)
+    # everything comes from the target image, the context is the Dockerfile
+    with tempfile.TemporaryDirectory() as empty_dir, get_context(
+        Path(empty_dir), "runtime", TOP_DIR / "fuzzdeploy" / "Dockerfile_runtime"
+    ) as context:
+        logs = get_session().client.api.build(
+            fileobj=context,
+            custom_context=True,
+            dockerfile=CONTEXT_DOCKERFILE,
             tag=image,
             buildargs={
                 "fuzzer_name": fuzzer,
                 "target_name": target,
             },
+            labels={HASH_LABEL: runtime_hash},
             rm=True,
             decode=True,
         )
-        target_log_path = log_path / f"{fuzzer}_{target}.log"
-        target_log_path, is_error = write_log(logs, target_log_path)
-        tmp_com_args["log_path"] = target_log_path.as_posix()
+        runtime_log_path = log_path / f"{fuzzer}_{target}_runtime.log"
+        runtime_log_path, is_error = write_log(logs, runtime_log_path)
+        tmp_com_args["log_path"] = runtime_log_path.as_posix()
         if is_error:
             return BuildImageResult(
                 **tmp_com_args,
                 code=1,
-                status=BuildStatus.TARGET_BUILD_FAILURE,
+                status=BuildStatus.RUNTIME_BUILD_FAILURE,
             )
+    get_session().add_image(image, runtime_hash)
     return BuildImageResult(
         **tmp_com_args,
         code=0,
-        status=BuildStatus.TARGET_BUILD_SUCCESS,
+        status=BuildStatus.RUNTIME_BUILD_SUCCESS,
     )
 
 
 def wrapper_build_fuzzer(args):
-    fuzzer, log_path, skip_existed_images = args
+    fuzzer, log_path, skip_existed_images, sources = args
     return build_fuzzer(
-        fuzzer=fuzzer, log_path=log_path, skip_existed_images=skip_existed_images
+        fuzzer=fuzzer,
+        log_path=log_path,
+        skip_existed_images=skip_existed_images,
+        sources=sources,
     )
 
 
 def wrapper_build_target(args):
-    fuzzer, target, log_path, skip_existed_images = args
+    fuzzer, target, log_path, skip_existed_images, sources, ccache = args
+    # the worker may have been forked before the fuzzer image was built
+    get_session().add_image(get_fuzzer_image_name(fuzzer))
     return build_target(
         fuzzer=fuzzer,
         target=target,
         log_path=log_path,
         skip_existed_images=skip_existed_images,
+        sources=sources,
+        ccache=ccache,
+    )
+
+
+def wrapper_build_runtime(args):
+    fuzzer, target, target_hash, log_path, skip_existed_images = args
+    # the worker may have been forked before the target image was built
+    get_session().add_image(get_target_image_name(fuzzer, target), target_hash)
+    return build_runtime(
+        fuzzer=fuzzer,
+        target=target,
+        log_path=log_path,
+        skip_existed_images=skip_existed_images,
     )
 
 
+def get_build_slots(jobs: int | None, memory_per_build: str) -> int:
+    # a build compiles with make -j $(nproc) on its own, so the cap is
+    # rather about memory than about cpus
+    slots = jobs or os.cpu_count() or 1
+    mem_total = get_session().info.get("MemTotal")
+    if mem_total:
+        slots = min(slots, mem_total // size_to_bytes(memory_per_build))
+    return max(1, slots)
+
+
 def build_image(
-    fuzzer: str, target: str, log_path: str | Path, skip_existed_images: bool = True
+    fuzzer: str,
+    target: str,
+    log_path: str | Path,
+    skip_existed_images: bool = True,
+    sources: SourceCache | None = None,
+    ccache: bool = False,
 ) -> BuildImageResult:
     res = build_fuzzer(
         fuzzer=fuzzer,
         log_path=log_path,
         skip_existed_images=skip_existed_images,
+        sources=sources,
     )
     if res.code == 1:
         return res
@@ -210,6 +586,8 @@ def build_image(
         target=target,
         log_path=log_path,
         skip_existed_images=skip_existed_images,
+        sources=sources,
+        ccache=ccache,
     )
 
 
@@ -220,26 +598,94 @@ def build_images(
     *,
     skip_existed_fuzzer_images: bool = True,
     skip_existed_target_images: bool = True,
+    gc: bool = True,
+    jobs: int | None = None,
+    memory_per_build: str = "4g",
+    sources: SourceCache | None = None,
+    ccache: bool = False,
+    runtime: bool = False,
 ) -> list[BuildImageResult]:
     assert isinstance(fuzzers, list), "fuzzers should be a list"
     assert len(fuzzers) > 0, "fuzzers should contain one element at least"
     assert isinstance(targets, list), "targets should be a list"
     assert len(targets) > 0, "targets should contain one element at least"
-    # build fuzzer images first for docker build cache
-    with multiprocessing.Pool() as pool:
-        results = pool.imap_unordered(
-            wrapper_build_fuzzer,
-            [(fuzzer, log_path, skip_existed_fuzzer_images) for fuzzer in fuzzers],
-        )
-        for _ in results:
-            pass
-    with multiprocessing.Pool() as pool:
-        results = pool.imap_unordered(
-            wrapper_build_target,
-            [
-                (fuzzer, target, log_path, skip_existed_target_images)
-                for fuzzer in fuzzers
-                for target in targets
-            ],
-        )
-        return list(results)
+    # workers inherit the inventory, so it is listed once
+    get_session().refresh_images()
+    # the targets of a fuzzer are built as soon as its image is ready,
+    # regardless of the other fuzzers, and so are their runtime images
+    results: list[BuildImageResult] = []
+    finished = queue.Queue()
+    total, count = len(fuzzers) * (len(targets) + 1), 0
+    with multiprocessing.Pool(get_build_slots(jobs, memory_per_build)) as pool:
+        for fuzzer in fuzzers:
+            pool.apply_async(
+                wrapper_build_fuzzer,
+                ((fuzzer, log_path, skip_existed_fuzzer_images, sources),),
+                callback=finished.put,
+                error_callback=finished.put,
+            )
+        while count < total:
+            result = finished.get()
+            if isinstance(result, BaseException):
+                raise result
+            count += 1
+            cache = " (cache hit)" if result.cache_hit else ""
+            print(f"[{count}/{total}] {result.image_name} {result.status.value}{cache}")
+            if result.target is not None:
+                results.append(result)
+                if (
+                    runtime
+                    and result.code == 0
+                    and result.fuzzer not in MAKE_FUZZERS
+                    and result.image_name
+                    == (get_target_image_name(result.fuzzer, result.target))
+                ):
+                    total += 1
+                    pool.apply_async(
+                        wrapper_build_runtime,
+                        (
+                            (
+                                result.fuzzer,
+                                result.target,
+                                get_target_hash(result.fuzzer, result.target, ccache),
+                                log_path,
+                                skip_existed_target_images,
+                            ),
+                        ),
+                        callback=finished.put,
+                        error_callback=finished.put,
+                    )
+            elif result.code == 0:
+                for target in targets:
+                    pool.apply_async(
+                        wrapper_build_target,
+                        (
+                            (
+                                result.fuzzer,
+                                target,
+                                log_path,
+                                skip_existed_target_images,
+                                sources,
+                                ccache,
+                            ),
+                        ),
+                        callback=finished.put,
+                        error_callback=finished.put,
+                    )
+            else:
+                # nothing to build the targets of a failed fuzzer on
+                for target in targets:
+                    finished.put(
+                        BuildImageResult(
+                            image_name=get_target_image_name(result.fuzzer, target),
+                            fuzzer=result.fuzzer,
+                            target=target,
+                            code=1,
+                            status=BuildStatus.FUZZER_IMAGE_NOT_EXISTENCE,
+                            log_path=None,
+                        )
+                    )
+    get_session().refresh_images()
+    if gc:
+        gc_images()
+    return results
@@ -0,0 +1,179 @@
+import json
+import os
+import shutil
+import time
+from enum import Enum
+from pathlib import Path
+from typing import NamedTuple
+
+from .jobs import FuzzingJob
+from .utils import get_item_paths, time_to_seconds
+
+MANIFEST_NAME = "campaign.json"
+# a run that ends this close to its timeout has used it, its clock starts a
+# moment before the run is recorded as started
+TIMEOUT_SLACK = 10
+
+
+class RunStatus(Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    INTERRUPTED = "interrupted"
+    FINISHED = "finished"
+
+
+class CampaignRun(NamedTuple):
+    fuzzer: str
+    target: str
+    repeat_idx: int
+    priority: int
+    timeout: int
+    elapsed: int = 0
+    idx: str | None = None
+    started_at: float | None = None
+    status: RunStatus = RunStatus.PENDING
+    instances: int = 1
+
+    @property
+    def key(self) -> tuple[str, str, int]:
+        return (self.fuzzer, self.target, self.repeat_idx)
+
+    @property
+    def remaining(self) -> int:
+        return max(self.timeout - self.elapsed, 0)
+
+    def get_job(self) -> FuzzingJob:
+        return FuzzingJob(
+            fuzzer=self.fuzzer,
+            target=self.target,
+            timeout=f"{self.remaining}s",
+            priority=self.priority,
+            instances=self.instances,
+        )
+
+
+def _get_last_activity(path: Path) -> float | None:
+    mtime = []
+    for item in ("fuzzer_stats", "plot_data", "output.log"):
+        for item_path in get_item_paths(path, item):
+            mtime.append(item_path.stat().st_mtime)
+    return max(mtime, default=None)
+
+
+def restore_crash_backups(path: str | Path):
+    # an in-place resume makes afl move crashes/ and hangs/ to crashes.<time>,
+    # move them back so that triage keeps seeing one crashes dir per run
+    path = Path(path)
+    for backup in list(path.glob("crashes.*")) + list(path.glob("*/crashes.*")):
+        _restore_backup(backup, backup.parent / "crashes")
+    for backup in list(path.glob("hangs.*")) + list(path.glob("*/hangs.*")):
+        _restore_backup(backup, backup.parent / "hangs")
+
+
+def _restore_backup(backup: Path, dst: Path):
+    if not backup.is_dir():
+        return
+    suffix = backup.name.split(".", 1)[1]
+    dst.mkdir(exist_ok=True)
+    for p in backup.iterdir():
+        name = p.name if p.name == "README.txt" else f"{p.name},resume:{suffix}"
+        if (dst / name).exists():
+            continue
+        p.rename(dst / name)
+    shutil.rmtree(backup, ignore_errors=True)
+
+
+class Campaign:
+    def __init__(self, work_dir: str | Path):
+        self.work_dir = Path(work_dir).absolute()
+        self.manifest_path = self.work_dir / MANIFEST_NAME
+        self.runs: dict[tuple[str, str, int], CampaignRun] = {}
+        if self.manifest_path.exists():
+            self._load()
+
+    def _load(self):
+        with open(self.manifest_path, "r") as f:
+            data = json.load(f)
+        for item in data["runs"]:
+            run = CampaignRun(**{**item, "status": RunStatus(item["status"])})
+            if run.status == RunStatus.RUNNING:
+                # the previous fuzzing() died with this run still running
+                elapsed = run.elapsed
+                last_activity = _get_last_activity(self.get_path(run))
+                if last_activity is not None and run.started_at is not None:
+                    elapsed += max(int(last_activity - run.started_at), 0)
+                run = run._replace(
+                    elapsed=elapsed, started_at=None, status=RunStatus.INTERRUPTED
+                )
+            self.runs[run.key] = run
+
+    def save(self):
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            "runs": [
+                {**run._asdict(), "status": run.status.value}
+                for run in self.runs.values()
+            ]
+        }
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+    def get(self, fuzzer: str, target: str, repeat_idx: int) -> CampaignRun | None:
+        return self.runs.get((fuzzer, target, repeat_idx))
+
+    def get_path(self, run: CampaignRun) -> Path:
+        assert run.idx is not None, f"{run} has not started yet"
+        return self.work_dir / "archive" / run.fuzzer / run.target / run.idx
+
+    def add(self, job: FuzzingJob, repeat_idx: int) -> CampaignRun:
+        run = CampaignRun(
+            fuzzer=job.fuzzer,
+            target=job.target,
+            repeat_idx=repeat_idx,
+            priority=job.priority,
+            timeout=time_to_seconds(job.timeout),
+            instances=job.instances,
+        )
+        self.runs[run.key] = run
+        return run
+
+    def start(self, key: tuple[str, str, int], idx: str):
+        self.runs[key] = self.runs[key]._replace(
+            idx=idx, started_at=time.time(), status=RunStatus.RUNNING
+        )
+        self.save()
+
+    def finish(self, key: tuple[str, str, int]):
+        self._end(key, RunStatus.FINISHED)
+        restore_crash_backups(self.get_path(self.runs[key]))
+
+    def release(self, key: tuple[str, str, int], stopped: bool = False):
+        # a run that exits before its timeout without being stopped early
+        # died, e.g. on a bad cpuset, and is left for a resume to retry
+        run = self.runs[key]
+        if stopped or run.timeout - self._get_elapsed(run) <= TIMEOUT_SLACK:
+            self.finish(key)
+        else:
+            self._end(key, RunStatus.INTERRUPTED)
+
+    def _get_elapsed(self, run: CampaignRun) -> int:
+        if run.started_at is None:
+            return run.elapsed
+        return run.elapsed + int(time.time() - run.started_at)
+
+    def _end(self, key: tuple[str, str, int], status: RunStatus):
+        run = self.runs[key]
+        self.runs[key] = run._replace(
+            elapsed=self._get_elapsed(run), started_at=None, status=status
+        )
+        self.save()
+
+    def extend(self, key: tuple[str, str, int], seconds: int):
+        run = self.runs[key]
+        assert run.status == RunStatus.FINISHED, f"{run} has not finished yet"
+        self.runs[key] = run._replace(
+            timeout=run.elapsed + seconds,
+            status=RunStatus.INTERRUPTED,
+        )
@@ -1,103 +1,241 @@
 import datetime
-import multiprocessing
 import re
-import time
+import threading
+from functools import partial
 from pathlib import Path
+from typing import Iterator
 
 import pandas as pd
 from styleframe import StyleFrame, Styler, utils
 
-from .make import make
-from .utils import WorkDirItem, get_item_path, work_dir_iterdir
+from .backend import DockerHost
+from .dispatch import Host, get_hosts
+from .make import build_base_images, make
+from .memory import MemoryPolicy
+from .triage import (
+    LEDGER_NAME,
+    CrashRecord,
+    CrashState,
+    TriageCache,
+    TriageLedger,
+    fill_cache,
+    get_crash_digest,
+    get_image_key,
+    get_item_key,
+    prepare_store,
+    seed_store,
+)
+from .utils import WorkDirItem, get_crashes, get_item_path, work_dir_iterdir
 
+# casr-san runs once per crash content and target across all runs, see
+# fuzzers/casr/triage.py, the ledger of the crash states is kept next to it
+STORE_DIR = ".casr"
 
-def _skip_handler(item: WorkDirItem) -> bool:
-    dst_path = item.work_dir / "casr" / item.fuzzer / item.target / item.idx
-    if not dst_path.exists():
-        return False
-    crash_set = set(
-        [p.name for p in item.path.glob("*") if p.is_file() and p.name.startswith("id")]
-    )
-    if len(crash_set) == 0 and not (dst_path / "summary_by_unique_line").exists():
-        return False
+
+def _get_dst_path(item: WorkDirItem) -> Path:
+    return item.work_dir / "casr" / item.fuzzer / item.target / item.idx
+
+
+def _scan_triaged(item: WorkDirItem) -> list[CrashRecord]:
+    # the ledger of a work_dir triaged before it had one
+    dst_path = _get_dst_path(item)
+    item_key = get_item_key(item)
+    records = []
     failed_path = dst_path / "failed"
     if failed_path.exists():
-        for p in failed_path.glob("*"):
-            if p.name in crash_set:
-                crash_set.remove(p.name)
+        for p in failed_path.glob("id*"):
+            records.append(
+                CrashRecord(item_key, p.name, CrashState.FAILED, CrashState.FAILED)
+            )
     reports_path = dst_path / "reports"
     if reports_path.exists():
-        for p in reports_path.glob("*"):
-            if not p.name.endswith(".casrep"):
-                continue
-            file_name = p.name.rstrip(".casrep")
-            if file_name in crash_set:
-                crash_set.remove(file_name)
-    return len(crash_set) == 0
+        for p in reports_path.glob("id*.casrep"):
+            records.append(
+                CrashRecord(
+                    item_key,
+                    p.name.removesuffix(".casrep"),
+                    CrashState.REPORTED,
+                    CrashState.REPORTED,
+                )
+            )
+    return records
 
 
-def _print_progress(work_dir: str | Path):
-    current_time = datetime.datetime.now()
-    work_dir = Path(work_dir).absolute()
-    untriaged = {}
-    total_number = 0
-    for item in work_dir_iterdir(work_dir, "archive"):
-        key = (item.fuzzer, item.target, item.idx)
-        untriaged[key] = set()
-        crashes_path = get_item_path(item.path, "crashes")
-        if not crashes_path:
-            print(f"{item.path} crashes not found")
+def _recover_triaged(item: WorkDirItem, untriaged: set[str]) -> list[CrashRecord]:
+    # results in place without a record, e.g. a triage killed right after
+    # renaming one, a stat per crash that is not triaged yet
+    dst_path = _get_dst_path(item)
+    item_key = get_item_key(item)
+    records = []
+    for crash in sorted(untriaged):
+        if (dst_path / "reports" / f"{crash}.casrep").exists():
+            state = CrashState.REPORTED
+        elif (dst_path / "failed" / crash).exists():
+            state = CrashState.FAILED
+        else:
             continue
-        for p in crashes_path.glob("*"):
-            if p.name.startswith("id"):
-                untriaged[key].add(p.name)
-        total_number += len(untriaged[key])
+        records.append(CrashRecord(item_key, crash, state, state))
+    return records
+
+
+class _Crashes:
+    # the crashes of the archive do not change while they are triaged
+    def __init__(self, ledger: TriageLedger):
+        self.ledger = ledger
+        self.crashes: dict[str, set[str]] = {}
+
+    def get(self, item: WorkDirItem) -> set[str]:
+        item_key = get_item_key(item)
+        if item_key not in self.crashes:
+            self.crashes[item_key] = set(get_crashes(item.path))
+        return self.crashes[item_key]
+
+    def get_untriaged(self, item: WorkDirItem) -> set[str]:
+        self.ledger.update()
+        return self.get(item) - self.ledger.get_triaged(get_item_key(item))
+
+
+def _skip_handler(item: WorkDirItem, crashes: _Crashes) -> bool:
+    dst_path = _get_dst_path(item)
+    if not dst_path.exists():
+        return False
+    if not crashes.get(item) and not (dst_path / "summary_by_unique_line").exists():
+        return False
+    return len(crashes.get_untriaged(item)) == 0
+
+
+def _work_handler(item: WorkDirItem, crashes: _Crashes) -> int:
+    # casr-san runs once per crash in parallel, clustering at the end is serial
+    return len(crashes.get_untriaged(item))
+
+
+def _progress_handler(ledger_path: Path, stopped: threading.Event) -> Iterator[str]:
+    # the items whose crashes were triaged meanwhile
+    ledger = TriageLedger(ledger_path)
+    while not stopped.wait(1):
+        for item_key in {
+            _.item for _ in ledger.update() if _.state != CrashState.PENDING
+        }:
+            yield item_key
+
+
+def _print_progress(
+    ledger_path: Path,
+    untriaged: dict[str, set[str]],
+    total: int,
+    stopped: threading.Event,
+):
+    current_time = datetime.datetime.now()
+    ledger = TriageLedger(ledger_path)
     while True:
-        if not (work_dir / "casr").exists():
-            time.sleep(1)
-            continue
-        for item in work_dir_iterdir(work_dir, "casr"):
-            dst_path = item.work_dir / "casr" / item.fuzzer / item.target / item.idx
-            if not dst_path.exists():
-                continue
-            crash_set = untriaged[(item.fuzzer, item.target, item.idx)]
-            failed_path = dst_path / "failed"
-            if failed_path.exists():
-                for p in failed_path.glob("*"):
-                    if p.name in crash_set:
-                        crash_set.remove(p.name)
-            reports_path = dst_path / "reports"
-            if reports_path.exists():
-                for p in reports_path.glob("*"):
-                    if not p.name.endswith(".casrep"):
-                        continue
-                    file_name = p.name.rstrip(".casrep")
-                    if file_name in crash_set:
-                        crash_set.remove(file_name)
+        # only the records appended meanwhile
+        for record in ledger.update():
+            if record.state != CrashState.PENDING and record.item in untriaged:
+                untriaged[record.item].discard(record.crash)
         current_total = sum([len(crash_set) for crash_set in untriaged.values()])
         print(
-            f"\rcost time: {(datetime.datetime.now()-current_time)} current progress: {total_number-current_total}/{total_number}",
+            f"\rcost time: {(datetime.datetime.now()-current_time)} current progress: {total-current_total}/{total}",
             end="",
             flush=True,
         )
-        time.sleep(1)
+        # the last line shows the final state
+        if stopped.is_set():
+            return
+        stopped.wait(1)
 
 
-def get(work_dir: str | Path):
+def get(
+    work_dir: str | Path,
+    *,
+    hosts: list[Host] | None = None,
+    memory: MemoryPolicy | None = None,
+    pool: bool = False,
+    cache: TriageCache | None = None,
+):
     work_dir = Path(work_dir).absolute()
-    p = multiprocessing.Process(target=_print_progress, args=(work_dir,), daemon=True)
-    p.start()
-    make(
-        work_dir=work_dir,
-        sub_dir="casr",
-        base_image="casr",
-        skip_handler=_skip_handler,
+    # created here, a missing bind mount would be created by docker as root
+    store_path = work_dir / STORE_DIR
+    store_path.mkdir(exist_ok=True)
+    ledger_path = store_path / LEDGER_NAME
+    migrate = not ledger_path.exists()
+    ledger = TriageLedger(ledger_path)
+    crashes = _Crashes(ledger)
+    keys = {}
+    digests: dict[str, set[str]] = {}
+    untriaged: dict[str, set[str]] = {}
+    total = 0
+    hosts = get_hosts(None, hosts)
+    if any(isinstance(host, DockerHost) for host in hosts):
+        # the results in the store belong to the current casr image
+        targets = set([_.target for _ in work_dir_iterdir(work_dir, "archive")])
+        build_base_images(work_dir, "casr", list(targets))
+    for item in work_dir_iterdir(work_dir, "archive"):
+        if item.target not in keys:
+            keys[item.target] = get_image_key(item.target, hosts)
+            prepare_store(store_path / item.target, keys[item.target])
+            digests[item.target] = set()
+        if migrate:
+            ledger.append(_scan_triaged(item))
+        if not get_item_path(item.path, "crashes"):
+            print(f"{item.path} crashes not found")
+            continue
+        item_key = get_item_key(item)
+        total += len(crashes.get(item))
+        ledger.append(_recover_triaged(item, crashes.get_untriaged(item)))
+        untriaged[item_key] = crashes.get_untriaged(item)
+        records = ledger.get_records(item_key)
+        ledger.append(
+            [
+                CrashRecord(item_key, crash, CrashState.PENDING)
+                for crash in sorted(untriaged[item_key])
+                if crash not in records
+            ]
+        )
+        if cache is None:
+            continue
+        paths = get_crashes(item.path)
+        for crash in untriaged[item_key]:
+            digests[item.target].add(get_crash_digest(paths[crash]))
+    if cache is not None:
+        seeded = 0
+        for target, key in keys.items():
+            seeded += seed_store(
+                cache, store_path / target, target, key, digests[target]
+            )
+        print(f"{seeded} crash contents found in {cache.path}")
+    stopped = threading.Event()
+    printer = threading.Thread(
+        target=_print_progress,
+        args=(ledger_path, untriaged, total, stopped),
+        daemon=True,
     )
-    p.terminate()
+    printer.start()
+    try:
+        make(
+            work_dir=work_dir,
+            sub_dir="casr",
+            base_image="casr",
+            skip_handler=partial(_skip_handler, crashes=crashes),
+            work_handler=partial(_work_handler, crashes=crashes),
+            progress_handler=partial(_progress_handler, ledger_path),
+            environment={"STORE": "/store"},
+            volumes={"/store": store_path},
+            hosts=hosts,
+            memory=memory,
+            pool=pool,
+        )
+    finally:
+        stopped.set()
+        printer.join()
     print()
+    if cache is not None:
+        for target, key in keys.items():
+            fill_cache(cache, store_path / target, target, key)
+    ledger.update()
     casr_res_ls = []
     for item in work_dir_iterdir(work_dir, "casr"):
-        dst_path = item.work_dir / "casr" / item.fuzzer / item.target / item.idx
+        dst_path = _get_dst_path(item)
+        results = [_.result for _ in ledger.get_records(get_item_key(item)).values()]
         casr_res = {
             "fuzzer": item.fuzzer,
             "target": item.target,
@@ -105,6 +243,8 @@ def get(work_dir: str | Path):
             "unique_line": 0,
             "casr_dedup": 0,
             "casr_dedup_cluster": 0,
+            "reported": results.count(CrashState.REPORTED),
+            "failed": results.count(CrashState.FAILED),
         }
         reports_dedup_path = dst_path / "reports_dedup"
         if reports_dedup_path.exists():
@@ -0,0 +1,138 @@
+from enum import Enum
+from pathlib import Path
+from typing import NamedTuple
+
+SYS_CPU_PATH = Path("/sys/devices/system/cpu")
+
+
+class AllocationPolicy(Enum):
+    # every logical cpu is a unit, hyperthread siblings included
+    LOGICAL = "logical"
+    # one logical cpu per physical core, siblings are left idle
+    PHYSICAL = "physical"
+    # like PHYSICAL, but a run never spans two NUMA nodes
+    NUMA = "numa"
+
+
+class CpuInfo(NamedTuple):
+    cpu: int
+    core: int
+    package: int
+    node: int
+
+
+def parse_cpu_list(cpu_list: str) -> list[int]:
+    cpus = []
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def read_cpu_topology(sys_path: str | Path = SYS_CPU_PATH) -> list[CpuInfo]:
+    sys_path = Path(sys_path)
+    online = None
+    if (sys_path / "online").exists():
+        online = set(parse_cpu_list((sys_path / "online").read_text()))
+    topology = []
+    for cpu_path in sys_path.glob("cpu[0-9]*"):
+        cpu = int(cpu_path.name[3:])
+        if online is not None and cpu not in online:
+            continue
+        topology_path = cpu_path / "topology"
+        if not topology_path.exists():
+            continue
+        node = 0
+        for node_path in cpu_path.glob("node[0-9]*"):
+            node = int(node_path.name[4:])
+            break
+        topology.append(
+            CpuInfo(
+                cpu=cpu,
+                core=int((topology_path / "core_id").read_text()),
+                package=int((topology_path / "physical_package_id").read_text()),
+                node=node,
+            )
+        )
+    return sorted(topology, key=lambda x: (x.node, x.package, x.core, x.cpu))
+
+
+class CpuAllocator:
+    def __init__(
+        self,
+        cpu_range: (list[str | int] | set[str | int]) | None = None,
+        *,
+        policy: AllocationPolicy | str = AllocationPolicy.PHYSICAL,
+        cores_per_run: int = 1,
+        sys_path: str | Path = SYS_CPU_PATH,
+    ):
+        assert cores_per_run > 0, "cores_per_run should be positive"
+        self.policy = AllocationPolicy(policy)
+        self.cores_per_run = cores_per_run
+        self.topology = read_cpu_topology(sys_path)
+        assert self.topology, f"no cpu topology found in {sys_path}"
+        if cpu_range is not None:
+            allowed = set(int(i) for i in cpu_range)
+            self.topology = [i for i in self.topology if i.cpu in allowed]
+        assert self.topology, "cpu_range should contain one element at least"
+
+    def _units(self) -> list[CpuInfo]:
+        if self.policy == AllocationPolicy.LOGICAL:
+            if self.cores_per_run > 1:
+                return self.topology
+            # hand out every physical core once before reusing a sibling
+            rank = {}
+            thread_rank = []
+            for info in self.topology:
+                key = (info.package, info.core)
+                rank[key] = rank.get(key, -1) + 1
+                thread_rank.append(rank[key])
+            return [
+                info
+                for _, info in sorted(
+                    zip(thread_rank, self.topology), key=lambda x: x[0]
+                )
+            ]
+        units = {}
+        for info in self.topology:
+            units.setdefault((info.package, info.core), info)
+        return list(units.values())
+
+    def slots(self) -> list[list[str]]:
+        units = self._units()
+        if self.policy == AllocationPolicy.NUMA:
+            groups = {}
+            for info in units:
+                groups.setdefault(info.node, []).append(info)
+            groups = list(groups.values())
+        else:
+            groups = [units]
+        slots = []
+        for group in groups:
+            # leftover cpus that can not fill a whole run stay idle
+            for i in range(0, len(group) - self.cores_per_run + 1, self.cores_per_run):
+                slots.append(
+                    [str(info.cpu) for info in group[i : i + self.cores_per_run]]
+                )
+        assert slots, f"not enough cpus for {self.cores_per_run} cores per run"
+        return slots
+
+    def cpus(self) -> list[str]:
+        return [cpu for slot in self.slots() for cpu in slot]
+
+
+def get_cpu_slots(
+    cpu_range: (list[str | int] | set[str | int] | CpuAllocator) | None, ncpu: int
+) -> list[list[str]]:
+    if isinstance(cpu_range, CpuAllocator):
+        return cpu_range.slots()
+    if cpu_range is None:
+        cpu_range = list(range(ncpu))
+    slots = [[str(i)] for i in sorted(set(int(i) for i in cpu_range))]
+    assert slots, "cpu_range should contain one element at least"
+    return slots
@@ -1,26 +1,27 @@
 import datetime
-import os
 import signal
-import time
 from functools import partial
 from pathlib import Path
 
-import docker
-from docker.models.containers import Container
-
+from .backend import RunSpec, TmpfsOutput
+from .campaign import Campaign, RunStatus
+from .cpu import CpuAllocator
+from .dispatch import Dispatcher, Host, get_hosts
+from .jobs import FuzzingJob, expand_jobs, make_jobs, plan_runs, print_plan
+from .logcap import LogPolicy, get_log_environment
+from .memory import MemoryEstimator, MemoryMonitor, MemoryPolicy, get_peak_rss
+from .stopping import STOP_REASON_FILE, EarlyStopper, StopRule
 from .utils import (
-    get_free_cpu,
+    get_item_path,
     get_target_image_name,
-    is_image_exist,
-    remove_exited_container,
+    size_to_bytes,
+    time_to_seconds,
 )
 
 
-def sigint_handler(signal, frame, container_ls):
+def sigint_handler(signal, frame, scheduler: Dispatcher):
     print("SIGINT received, stopping all containers")
-    for container in container_ls:
-        container.stop()
-        container.remove()
+    scheduler.stop()
     import sys
 
     sys.exit(1)
@@ -37,86 +38,255 @@ def _get_idx(path: str | Path) -> int:
     return max(idx) + 1
 
 
+def _launch(
+    work_dir: Path,
+    campaign: Campaign,
+    runs: list[tuple[FuzzingJob, int]],
+    hosts: list[Host],
+    stop_rule: StopRule | None,
+    memory: MemoryPolicy | None,
+    tmpfs: TmpfsOutput | None,
+    log: LogPolicy | None,
+):
+    dispatcher = Dispatcher(
+        hosts, memory_fraction=memory.host_fraction if memory else 1.0
+    )
+    # check if the images exist
+    for host, backend in zip(hosts, dispatcher.backends):
+        for job, _ in runs:
+            assert backend.is_image_exist(
+                job.fuzzer, job.target
+            ), f"{get_target_image_name(job.fuzzer, job.target)} not found on {host.name}"
+    plan = plan_runs(runs, dispatcher.slot_count)
+    print_plan(plan, dispatcher.slot_count)
+
+    signal.signal(signal.SIGINT, partial(sigint_handler, scheduler=dispatcher))
+
+    def release_run(container):
+        key = (
+            container.labels["fuzzer"],
+            container.labels["target"],
+            int(container.labels["repeat_idx"]),
+        )
+        path = campaign.get_path(campaign.runs[key])
+        campaign.release(key, stopped=(path / STOP_REASON_FILE).exists())
+
+    dispatcher.on_release.append(release_run)
+    estimator = monitor = None
+    if memory is not None:
+        estimator = MemoryEstimator(work_dir, memory)
+        monitor = MemoryMonitor(dispatcher, memory.interval)
+
+        def record_memory(container):
+            path = (
+                work_dir
+                / "archive"
+                / container.labels["fuzzer"]
+                / container.labels["target"]
+                / container.labels["idx"]
+            )
+            peak = max(monitor.pop_peak(container.id), get_peak_rss(path))
+            # the estimate is per instance
+            estimator.record(
+                container.labels["fuzzer"],
+                container.labels["target"],
+                peak // int(container.labels.get("instances", 1)),
+            )
+
+        dispatcher.on_release.append(record_memory)
+    dispatcher.start()
+    if monitor is not None:
+        monitor.start()
+    stopper = None
+    if stop_rule is not None:
+        stopper = EarlyStopper(dispatcher, work_dir, stop_rule)
+        stopper.start()
+    start_script = Path(__file__).parent.absolute() / "start.sh"
+    for run in plan:
+        fuzzer, target = run.job.fuzzer, run.job.target
+        record = campaign.get(fuzzer, target, run.repeat_idx)
+        assert record is not None, f"{run} not found in {campaign.manifest_path}"
+        mem, mem_limit = 0, None
+        if estimator is not None:
+            mem = estimator.estimate(fuzzer, target) * run.job.instances
+            mem_limit = estimator.limit(fuzzer, target)
+            if mem_limit is not None:
+                mem_limit *= run.job.instances
+            if tmpfs is not None:
+                # the output in memory counts against the run as well
+                mem += size_to_bytes(tmpfs.size)
+                if mem_limit is not None:
+                    mem_limit += size_to_bytes(tmpfs.size)
+        host_idx, slots = dispatcher.acquire(run.job.instances, mem)
+        host = hosts[host_idx]
+        cpu_id = ",".join(slots)
+        environment = get_log_environment(log) if log else {}
+        if record.idx is None:
+            base_path = work_dir / "archive" / fuzzer / target
+            idx = str(_get_idx(base_path))
+            host_path = base_path / idx
+            host_path.mkdir(parents=True)
+        else:
+            idx = record.idx
+            host_path = campaign.get_path(record)
+            host_path.mkdir(parents=True, exist_ok=True)
+            if get_item_path(host_path, "fuzzer_stats") is not None:
+                # resume in place from the queue of the previous session
+                environment["CORPUS"] = "-"
+        if run.job.instances > 1:
+            environment["INSTANCES"] = str(run.job.instances)
+        labels = {
+            "fuzzer": fuzzer,
+            "target": target,
+            "idx": idx,
+            "repeat_idx": str(run.repeat_idx),
+            "instances": str(run.job.instances),
+            "host_idx": str(host_idx),
+        }
+        if tmpfs is not None:
+            labels["stop_timeout"] = str(tmpfs.stop_timeout)
+        container = dispatcher.backends[host_idx].launch(
+            RunSpec(
+                name=f"{fuzzer}-{target}-{idx}",
+                fuzzer=fuzzer,
+                target=target,
+                script=start_script,
+                cpuset=cpu_id,
+                volumes={"/shared": host_path},
+                environment=environment,
+                labels=labels,
+                timeout=run.job.timeout,
+                mem_limit=mem_limit,
+                tmpfs=tmpfs,
+                runtime=True,
+            ),
+            resume=record.idx is not None,
+        )
+        # before register(), which releases a run that already exited
+        campaign.start(record.key, idx)
+        dispatcher.register(host_idx, container, slots, mem)
+        print(
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            container.short_id,
+            fuzzer.ljust(16),
+            target.ljust(10),
+            str(run.repeat_idx).ljust(3),
+            run.job.timeout.ljust(5),
+            "resumes on cpu" if "CORPUS" in environment else "starts on cpu",
+            cpu_id,
+            f"@ {host.name}" if len(hosts) > 1 else "",
+        )
+    dispatcher.wait()
+    if stopper is not None:
+        stopper.close()
+    if monitor is not None:
+        monitor.close()
+    print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} DONE")
+    print(f"The results can be found in {work_dir/'archive'}")
+
+
 def fuzzing(
     work_dir: str | Path,
-    fuzzers: list[str],
-    targets: list[str],
-    timeout: str,
+    fuzzers: list[str] | None = None,
+    targets: list[str] | None = None,
+    timeout: str | None = None,
     repeat: int = 1,
+    instances: int = 1,
     *,
-    cpu_range: (list[str | int] | set[str | int]) | None = None,
+    jobs: list[FuzzingJob] | None = None,
+    cpu_range: (list[str | int] | set[str | int] | CpuAllocator) | None = None,
+    stop_rule: StopRule | None = None,
+    memory: MemoryPolicy | None = None,
+    tmpfs: TmpfsOutput | None = None,
+    log: LogPolicy | None = None,
+    resume: bool = True,
+    hosts: list[Host] | None = None,
 ):
     assert work_dir, "work_dir should not be None"
     work_dir = Path(work_dir).absolute()
-    assert fuzzers and len(fuzzers) > 0, "fuzzers should contain one element at least"
-    assert targets and len(targets) > 0, "targets should contain one element at least"
-    assert timeout, "timeout should not be None"
-    if cpu_range is not None:
-        cpu_range = [str(i) for i in cpu_range]
-    else:
-        cpu_range = set(
-            [str(i) for i in range(int(docker.from_env().info().get("NCPU")))]
+    if jobs is None:
+        assert (
+            fuzzers and len(fuzzers) > 0
+        ), "fuzzers should contain one element at least"
+        assert (
+            targets and len(targets) > 0
+        ), "targets should contain one element at least"
+        assert timeout, "timeout should not be None"
+        jobs = make_jobs(fuzzers, targets, timeout, repeat, instances)
+    assert jobs and len(jobs) > 0, "jobs should contain one element at least"
+    for job in jobs:
+        assert time_to_seconds(job.timeout) > 0, f"invalid timeout in {job}"
+        assert job.instances > 0, f"invalid instances in {job}"
+    campaign = Campaign(work_dir)
+    runs = []
+    for job, repeat_idx in expand_jobs(jobs):
+        record = campaign.get(job.fuzzer, job.target, repeat_idx)
+        if record is None or not resume:
+            campaign.add(job, repeat_idx)
+            runs.append((job, repeat_idx))
+        elif record.status == RunStatus.FINISHED:
+            continue
+        elif record.idx is not None and record.remaining == 0:
+            # interrupted right before its timeout
+            campaign.finish(record.key)
+        else:
+            runs.append((record.get_job(), repeat_idx))
+    campaign.save()
+    if len(runs) < sum(job.repeat for job in jobs):
+        print(
+            f"{sum(job.repeat for job in jobs) - len(runs)} runs already finished,",
+            f"see {campaign.manifest_path}",
         )
-    assert cpu_range, "cpu_range should contain one element at least"
-    # check if the images exist
-    for fuzzer in fuzzers:
-        for target in targets:
-            target_image_name = get_target_image_name(fuzzer, target)
-            assert is_image_exist(
-                target_image_name
-            ), f"docker image {target_image_name} not found"
-
-    container_ls: list[Container] = []
-    signal.signal(signal.SIGINT, partial(sigint_handler, container_ls=container_ls))
-    for repeat_idx in range(repeat):
-        for fuzzer in fuzzers:
-            for target in targets:
-                cpu_id = get_free_cpu(container_ls, cpu_range)  # type: ignore
-                while cpu_id is None:
-                    time.sleep(10)
-                    remove_exited_container(container_ls)
-                    cpu_id = get_free_cpu(container_ls, cpu_range)  # type: ignore
-                base_path = work_dir / "archive" / fuzzer / target
-                idx = str(_get_idx(base_path))
-                host_path = base_path / idx
-                host_path.mkdir(parents=True)
-                container = docker.from_env().containers.run(
-                    image=get_target_image_name(fuzzer, target),
-                    command=f"-c 'timeout {timeout} ${{SRC}}/script.sh'",
-                    cap_add=["SYS_PTRACE"],
-                    cpuset_cpus=cpu_id,
-                    detach=True,
-                    name=f"{fuzzer}-{target}-{idx}",
-                    network_mode="none",
-                    privileged=True,
-                    tty=True,
-                    security_opt=["seccomp=unconfined"],
-                    volumes={
-                        host_path.as_posix(): {"bind": "/shared", "mode": "rw"},
-                        (Path(__file__).parent.absolute() / "start.sh").as_posix(): {
-                            "bind": "/src/script.sh",
-                            "mode": "ro",
-                        },
-                    },  # type: ignore
-                    labels={
-                        "fuzzer": fuzzer,
-                        "target": target,
-                        "idx": idx,
-                    },
-                    user=f"{os.getuid()}:{os.getgid()}",
-                )
-                container_ls.append(container)
-                print(
-                    datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    container.short_id,
-                    fuzzer.ljust(16),
-                    target.ljust(10),
-                    str(repeat_idx).ljust(3),
-                    "starts on cpu",
-                    cpu_id,
-                )
-    for container in container_ls:
-        container.wait()
-        container.remove()
-    print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} DONE")
-    print(f"The results can be found in {work_dir/'archive'}")
+    _launch(
+        work_dir,
+        campaign,
+        runs,
+        get_hosts(cpu_range, hosts),
+        stop_rule,
+        memory,
+        tmpfs,
+        log,
+    )
+
+
+def extend(
+    work_dir: str | Path,
+    duration: str,
+    *,
+    fuzzers: list[str] | None = None,
+    targets: list[str] | None = None,
+    cpu_range: (list[str | int] | set[str | int] | CpuAllocator) | None = None,
+    stop_rule: StopRule | None = None,
+    memory: MemoryPolicy | None = None,
+    tmpfs: TmpfsOutput | None = None,
+    log: LogPolicy | None = None,
+    hosts: list[Host] | None = None,
+):
+    work_dir = Path(work_dir).absolute()
+    seconds = time_to_seconds(duration)
+    assert seconds > 0, f"invalid duration {duration}"
+    campaign = Campaign(work_dir)
+    assert campaign.runs, f"{campaign.manifest_path} not found"
+    runs = []
+    for record in list(campaign.runs.values()):
+        if record.status != RunStatus.FINISHED:
+            continue
+        if fuzzers and record.fuzzer not in fuzzers:
+            continue
+        if targets and record.target not in targets:
+            continue
+        campaign.extend(record.key, seconds)
+        (campaign.get_path(record) / STOP_REASON_FILE).unlink(missing_ok=True)
+        runs.append((campaign.runs[record.key].get_job(), record.repeat_idx))
+    assert runs, "no finished run to extend"
+    campaign.save()
+    _launch(
+        work_dir,
+        campaign,
+        runs,
+        get_hosts(cpu_range, hosts),
+        stop_rule,
+        memory,
+        tmpfs,
+        log,
+    )
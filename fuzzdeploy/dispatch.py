@@ -0,0 +1,122 @@
+import queue
+from typing import Callable
+
+from .backend import DockerBackend, DockerHost, ProcessBackend, ProcessHost
+from .cpu import CpuAllocator
+
+Host = DockerHost | ProcessHost
+Backend = DockerBackend | ProcessBackend
+
+
+def get_hosts(
+    cpu_range: (list[str | int] | set[str | int] | CpuAllocator) | None,
+    hosts: list[Host] | None,
+) -> list[Host]:
+    if hosts is None:
+        return [DockerHost(cpu_range=cpu_range)]
+    assert cpu_range is None, "cpu_range should be given per host"
+    assert hosts and len(hosts) > 0, "hosts should contain one element at least"
+    return hosts
+
+
+class Dispatcher:
+    def __init__(
+        self,
+        hosts: list[Host],
+        *,
+        reconcile_interval: int = 60,
+        memory_fraction: float = 1.0,
+    ):
+        assert hosts, "hosts should contain one element at least"
+        self.hosts = hosts
+        self.memory_fraction = memory_fraction
+        self.on_release: list[Callable] = []
+        self.reconcile_interval = reconcile_interval
+        # None only wakes up the waiting ones, see notify
+        self._exited: queue.Queue[str | None] = queue.Queue()
+        self.backends: list[Backend] = []
+        for host in hosts:
+            backend = host.get_backend(
+                reconcile_interval=reconcile_interval, exited=self._exited
+            )
+            backend.on_release = self.on_release
+            self.backends.append(backend)
+
+    @property
+    def slot_count(self) -> int:
+        return sum(len(backend.slot_order) for backend in self.backends)
+
+    @property
+    def containers(self) -> dict:
+        containers = {}
+        for backend in self.backends:
+            containers.update(backend.containers)
+        return containers
+
+    def start(self):
+        for backend in self.backends:
+            backend.start()
+
+    def wait_exited(self):
+        # returns after one exit, a notify() or a reconcile of the backends
+        try:
+            container_id = self._exited.get(timeout=self.reconcile_interval)
+        except queue.Empty:
+            for backend in self.backends:
+                backend._reconcile()
+            return
+        if container_id is None:
+            return
+        for backend in self.backends:
+            backend.release(container_id)
+
+    def notify(self):
+        # e.g. a run made progress, make.make rebalances the cpus
+        self._exited.put(None)
+
+    def get_memory_capacity(self, host_idx: int) -> int | None:
+        memory_total = self.backends[host_idx].get_memory_total()
+        if memory_total is None:
+            return None
+        return int(memory_total * self.memory_fraction)
+
+    def _fits(self, host_idx: int, count: int, memory: int) -> bool:
+        backend = self.backends[host_idx]
+        if len(backend.free_slots) < count:
+            return False
+        capacity = self.get_memory_capacity(host_idx)
+        if not memory or capacity is None:
+            return True
+        # a run is never refused on an idle host, it would wait forever
+        if not backend.containers:
+            return True
+        return backend.memory_used + memory <= capacity
+
+    def acquire(self, count: int = 1, memory: int = 0) -> tuple[int, list[str]]:
+        # the slots of one run are always taken from the same host
+        candidates = [
+            i
+            for i, backend in enumerate(self.backends)
+            if len(backend.slot_order) >= count
+        ]
+        assert candidates, f"no host has {count} slots"
+        while True:
+            # spread runs over the hosts, the one with most free slots first
+            fits = [i for i in candidates if self._fits(i, count, memory)]
+            if fits:
+                host_idx = max(fits, key=lambda i: len(self.backends[i].free_slots))
+                return host_idx, self.backends[host_idx].acquire(count)
+            self.wait_exited()
+
+    def register(self, host_idx: int, container, slots: list[str], memory: int = 0):
+        self.backends[host_idx].register(container, slots, memory)
+
+    def wait(self):
+        while any(backend.containers for backend in self.backends):
+            self.wait_exited()
+        for backend in self.backends:
+            backend.close()
+
+    def stop(self):
+        for backend in self.backends:
+            backend.stop()
@@ -4,22 +4,21 @@ import numpy as np
 import pandas as pd
 from styleframe import StyleFrame, Styler, utils
 
-from .utils import get_item_path, work_dir_iterdir
+from .stopping import STOP_REASON_FILE
+from .utils import read_run_stats, work_dir_iterdir
 
 
 def get(work_dir: str | Path):
     data = []
     work_dir = Path(work_dir).absolute()
     for item in work_dir_iterdir(work_dir, "archive"):
-        fuzzer_status_path = get_item_path(item.path, "fuzzer_stats")
-        if fuzzer_status_path is None:
+        tmp = read_run_stats(item.path)
+        if tmp is None:
             print(f"{item.path}  fuzzer_stats not exists")
             continue
-        content = fuzzer_status_path.open("r", encoding="utf-8").read()
-        tmp = {}
-        for line in content.strip().split("\n"):
-            key, value = line.split(":", 1)
-            tmp[key.strip()] = value.strip()
+        stop_reason_path = item.path / STOP_REASON_FILE
+        if stop_reason_path.exists():
+            tmp["stop_reason"] = stop_reason_path.read_text().strip()
         tmp["fuzzer"] = item.fuzzer
         tmp["target"] = item.target
         tmp["idx"] = item.idx
@@ -64,6 +63,7 @@ def to_excel(work_dir: str | Path):
             "fuzzer",
             "target",
             "idx",
+            "instances",
             "crashes",
             "bitmap_cvg",
             "execs_done",
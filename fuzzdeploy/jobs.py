@@ -0,0 +1,92 @@
+import datetime
+import heapq
+from typing import NamedTuple
+
+from .utils import time_to_seconds
+
+
+class FuzzingJob(NamedTuple):
+    fuzzer: str
+    target: str
+    timeout: str
+    repeat: int = 1
+    priority: int = 0
+    # one main and instances - 1 secondary afl-fuzz sharing the output dir,
+    # every instance gets a slot of its own
+    instances: int = 1
+
+
+class PlannedRun(NamedTuple):
+    job: FuzzingJob
+    repeat_idx: int
+    start: int
+    end: int
+
+
+def make_jobs(
+    fuzzers: list[str],
+    targets: list[str],
+    timeout: str,
+    repeat: int = 1,
+    instances: int = 1,
+) -> list[FuzzingJob]:
+    return [
+        FuzzingJob(
+            fuzzer=fuzzer,
+            target=target,
+            timeout=timeout,
+            repeat=repeat,
+            instances=instances,
+        )
+        for fuzzer in fuzzers
+        for target in targets
+    ]
+
+
+def expand_jobs(jobs: list[FuzzingJob]) -> list[tuple[FuzzingJob, int]]:
+    runs = []
+    for repeat_idx in range(max(job.repeat for job in jobs)):
+        for job in jobs:
+            if repeat_idx < job.repeat:
+                runs.append((job, repeat_idx))
+    return runs
+
+
+def plan_runs(runs: list[tuple[FuzzingJob, int]], slot_count: int) -> list[PlannedRun]:
+    assert slot_count > 0, "slot_count should be positive"
+    for job, _ in runs:
+        assert job.instances <= slot_count, f"not enough slots for {job}"
+    runs = list(runs)
+    # higher priority first, longest processing time first within a priority,
+    # the sort is stable so equal jobs keep the repeat -> fuzzer -> target order
+    runs.sort(key=lambda x: (-x[0].priority, -time_to_seconds(x[0].timeout)))
+    # list scheduling: every run starts once the slots it needs free up
+    slots = [0] * slot_count
+    plan = []
+    for job, repeat_idx in runs:
+        start = max(heapq.heappop(slots) for _ in range(job.instances))
+        end = start + time_to_seconds(job.timeout)
+        for _ in range(job.instances):
+            heapq.heappush(slots, end)
+        plan.append(PlannedRun(job=job, repeat_idx=repeat_idx, start=start, end=end))
+    return plan
+
+
+def plan_jobs(jobs: list[FuzzingJob], slot_count: int) -> list[PlannedRun]:
+    return plan_runs(expand_jobs(jobs), slot_count)
+
+
+def get_makespan(plan: list[PlannedRun]) -> int:
+    return max([run.end for run in plan], default=0)
+
+
+def print_plan(plan: list[PlannedRun], slot_count: int):
+    makespan = get_makespan(plan)
+    now = datetime.datetime.now()
+    print(
+        now.strftime("%Y-%m-%d %H:%M:%S"),
+        f"{len(plan)} runs on {slot_count} slots,",
+        f"makespan {datetime.timedelta(seconds=makespan)},",
+        "predicted completion",
+        (now + datetime.timedelta(seconds=makespan)).strftime("%Y-%m-%d %H:%M:%S"),
+    )
@@ -0,0 +1,91 @@
+import gzip
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+from .utils import size_to_bytes
+
+# a line that redraws the screen or overwrites itself, e.g. the afl status
+# screen or a download progress bar
+FRAME_START = re.compile(r"\x1b\[H|\x1b\[2J|\r")
+ESCAPE = "\x1b"
+# unlike str.splitlines a carriage return does not end a line
+LINE = re.compile(r"[^\n]+\n?|\n")
+
+
+class LogPolicy(NamedTuple):
+    # size of the live log before it is rotated into <log>.1.gz
+    max_size: str = "16m"
+    # rotated logs that are kept, the oldest is dropped
+    backups: int = 3
+    # seconds between two status frames that are kept
+    frame_interval: int = 60
+
+
+def get_log_environment(policy: LogPolicy) -> dict[str, str]:
+    # start.sh captures the output of the fuzzers with the same rules
+    return {
+        "LOG_MAX_SIZE": str(size_to_bytes(policy.max_size)),
+        "LOG_BACKUPS": str(policy.backups),
+        "LOG_FRAME_INTERVAL": str(policy.frame_interval),
+    }
+
+
+def rotate_log(path: Path, backups: int):
+    for i in range(backups - 1, 0, -1):
+        backup = path.with_name(f"{path.name}.{i}.gz")
+        if backup.exists():
+            os.replace(backup, path.with_name(f"{path.name}.{i + 1}.gz"))
+    if backups > 0:
+        with open(path, "rb") as src, gzip.open(
+            path.with_name(f"{path.name}.1.gz"), "wb"
+        ) as dst:
+            shutil.copyfileobj(src, dst)
+    path.unlink()
+
+
+class LogWriter:
+    def __init__(self, path: str | Path, policy: LogPolicy | None = None):
+        self.path = Path(path)
+        self.policy = policy or LogPolicy()
+        self.max_size = size_to_bytes(self.policy.max_size)
+        self.file = open(self.path, "a")
+        self.size = self.file.tell()
+        self.last_frame = float("-inf")
+        self.keep_frame = True
+
+    def _is_kept(self, line: str) -> bool:
+        if FRAME_START.search(line):
+            now = time.monotonic()
+            self.keep_frame = now - self.last_frame >= self.policy.frame_interval
+            if self.keep_frame:
+                self.last_frame = now
+            return self.keep_frame
+        # the rest of a frame goes with its first line
+        if ESCAPE in line:
+            return self.keep_frame
+        return True
+
+    def write(self, text: str):
+        for line in LINE.findall(text):
+            if not self._is_kept(line):
+                continue
+            self.file.write(line)
+            self.size += len(line.encode(errors="replace"))
+            if self.size >= self.max_size:
+                self.file.close()
+                rotate_log(self.path, self.policy.backups)
+                self.file = open(self.path, "a")
+                self.size = 0
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,20 +1,162 @@
-import os
-import time
+import math
+import shutil
+import threading
 from pathlib import Path
-from typing import Callable
-
-import docker
-from docker.errors import APIError
-from docker.models.containers import Container
+from typing import Callable, Iterator
 
+from .backend import DockerHost, RunSpec
 from .build import build_images
-from .utils import (
-    WorkDirItem,
-    get_free_cpu,
-    get_target_image_name,
-    remove_exited_container,
-    work_dir_iterdir,
-)
+from .cpu import CpuAllocator
+from .dispatch import Dispatcher, Host, get_hosts
+from .memory import MemoryEstimator, MemoryMonitor, MemoryPolicy
+from .utils import WorkDirItem, get_target_image_name, work_dir_iterdir
+
+WORKER_SCRIPT = Path(__file__).parent.absolute() / "worker.sh"
+# fuzzers/<base_image>/run.sh runs once per archive item
+FUZZERS_DIR = Path(__file__).parent.parent.absolute() / "fuzzers"
+
+
+def _get_work(
+    work_handler: Callable[[WorkDirItem], int] | None, item: WorkDirItem
+) -> float:
+    # remaining units of work that can run in parallel, unknown means unbounded
+    if work_handler is None:
+        return float("inf")
+    return work_handler(item)
+
+
+class _WorkCache:
+    # the work of an item is counted again only once its run made progress
+    def __init__(self, work_handler: Callable[[WorkDirItem], int] | None):
+        self.work_handler = work_handler
+        self.counts: dict[str, float] = {}
+        self.stale: set[str] = set()
+        self.lock = threading.Lock()
+
+    def get(self, item: WorkDirItem) -> float:
+        item_key = f"{item.fuzzer}/{item.target}/{item.idx}"
+        with self.lock:
+            if item_key in self.counts and item_key not in self.stale:
+                return self.counts[item_key]
+            # the count may scan a run dir, it is not worth holding the lock
+            self.stale.discard(item_key)
+        count = _get_work(self.work_handler, item)
+        with self.lock:
+            # a progress seen meanwhile makes the count stale again
+            if item_key not in self.stale:
+                self.counts[item_key] = count
+        return count
+
+    def invalidate(self, item_key: str):
+        with self.lock:
+            self.stale.add(item_key)
+
+
+def _watch_progress(
+    progress_handler: Callable[[threading.Event], Iterator[str]],
+    on_progress: Callable[[str], None],
+    stopped: threading.Event,
+):
+    # the handler returns once stopped is set, also while nothing happens
+    for item_key in progress_handler(stopped):
+        if stopped.is_set():
+            return
+        on_progress(item_key)
+
+
+def _rebalance(
+    dispatcher: Dispatcher,
+    get_item: Callable[[str], WorkDirItem | None],
+    get_work: Callable[[WorkDirItem], float],
+):
+    for backend in dispatcher.backends:
+        work = {}
+        for container_id in backend.containers:
+            item = get_item(container_id)
+            # an idle worker has nothing to share its cpus with
+            work[container_id] = 0 if item is None else get_work(item)
+        # what is left is serial, the extra cpus would only idle
+        for container_id, remaining in work.items():
+            if remaining <= 1:
+                backend.shrink(container_id)
+        while backend.free_slots:
+            candidates = [
+                container_id
+                for container_id, remaining in work.items()
+                if remaining > len(backend.cpu_bindings[container_id])
+            ]
+            if not candidates:
+                break
+            # the most remaining work per cpu first
+            container_id = max(
+                candidates,
+                key=lambda x: (
+                    work[x] / len(backend.cpu_bindings[x]),
+                    -len(backend.cpu_bindings[x]),
+                ),
+            )
+            backend.grow(container_id)
+
+
+class WorkerPool:
+    # one job queue per target, drained by long-lived workers of that target
+    def __init__(self, work_dir: Path, sub_dir: str, todo_ls: list[WorkDirItem]):
+        self.root = work_dir / ".jobs" / sub_dir
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.items = {f"{_.fuzzer}/{_.target}/{_.idx}": _ for _ in todo_ls}
+        self.targets: dict[str, int] = {}
+        for n, item in enumerate(todo_ls):
+            jobs_dir = self.get_jobs_dir(item.target)
+            jobs_dir.mkdir(parents=True, exist_ok=True)
+            # the order of todo_ls is kept, most work first
+            with open(jobs_dir / f"{n:08d}.job", "w") as f:
+                f.write(f"{item.fuzzer}/{item.target}/{item.idx}")
+            self.targets[item.target] = self.targets.get(item.target, 0) + 1
+        for target in self.targets:
+            # workers exit once the queue is empty instead of waiting for more
+            (self.get_jobs_dir(target) / "closed").touch()
+        # container id -> (target, worker name)
+        self.workers: dict[str, tuple[str, str]] = {}
+
+    def get_jobs_dir(self, target: str) -> Path:
+        return self.root / target
+
+    def get_queued(self, target: str) -> int:
+        return len(list(self.get_jobs_dir(target).glob("*.job")))
+
+    def get_worker_counts(self, slot_count: int) -> dict[str, int]:
+        # workers in proportion to the items of a target, one at least
+        total = sum(self.targets.values())
+        return {
+            target: min(count, max(1, math.ceil(count * slot_count / total)))
+            for target, count in self.targets.items()
+        }
+
+    def get_item(self, container_id: str) -> WorkDirItem | None:
+        if container_id not in self.workers:
+            return None
+        target, worker = self.workers[container_id]
+        for claimed in self.get_jobs_dir(target).glob(f"*.{worker}"):
+            try:
+                return self.items.get(claimed.read_text().strip())
+            except OSError:
+                return None
+        return None
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def build_base_images(work_dir: Path, base_image: str, targets: list[str]):
+    build_image_result_ls = build_images(
+        fuzzers=[base_image],
+        targets=targets,
+        log_path=work_dir / "logs",
+    )
+    for build_image_result in build_image_result_ls:
+        assert (
+            build_image_result.code == 0
+        ), f"{build_image_result.image_name} build failed"
 
 
 def make(
@@ -23,20 +165,26 @@ def make(
     sub_dir: str,
     base_image: str,
     skip_handler: Callable[[WorkDirItem], bool] | None = None,
-    cpu_range: (list[str | int] | set[str | int]) | None = None,
+    work_handler: Callable[[WorkDirItem], int] | None = None,
+    progress_handler: Callable[[threading.Event], Iterator[str]] | None = None,
+    cpu_range: (list[str | int] | set[str | int] | CpuAllocator) | None = None,
     environment: dict | None = None,
+    volumes: dict | None = None,
+    hosts: list[Host] | None = None,
+    memory: MemoryPolicy | None = None,
+    pool: bool = False,
 ) -> None:
     assert sub_dir, "sub_dir should not be None"
     assert base_image, "base_image should not be None"
-    if cpu_range is not None:
-        cpu_range = [str(i) for i in cpu_range]
-    else:
-        cpu_range = set(
-            [str(i) for i in range(int(docker.from_env().info().get("NCPU")))]
-        )
-    assert cpu_range, "cpu_range should contain one element at least"
+    hosts = get_hosts(cpu_range, hosts)
+    for host in hosts:
+        # the results are written straight into work_dir
+        assert host.is_shared_fs, f"{host.name} can not see {work_dir}"
     if not environment:
         environment = {}
+    # mounted into every run next to its own directories
+    if not volumes:
+        volumes = {}
     work_dir = Path(work_dir).absolute()
     todo_ls: list[WorkDirItem] = []
     for item in work_dir_iterdir(work_dir, "archive"):
@@ -46,88 +194,136 @@ def make(
         todo_ls.append(item)
     if not todo_ls:
         return
-    build_image_result_ls = build_images(
-        fuzzers=[base_image],
-        targets=list(set([_.target for _ in todo_ls])),
-        log_path=work_dir / "logs",
+    # start the items with the most work first
+    work = _WorkCache(work_handler)
+    todo_ls.sort(key=work.get, reverse=True)
+    if any(isinstance(host, DockerHost) for host in hosts):
+        build_base_images(work_dir, base_image, list(set([_.target for _ in todo_ls])))
+    dispatcher = Dispatcher(
+        hosts, memory_fraction=memory.host_fraction if memory else 1.0
     )
-    for build_image_result in build_image_result_ls:
-        assert (
-            build_image_result.code == 0
-        ), f"{build_image_result.image_name} build failed"
-    container_ls: list[Container] = []
-    for item in todo_ls:
-        dst_path = work_dir / sub_dir / item.fuzzer / item.target / item.idx
-        dst_path.mkdir(parents=True, exist_ok=True)
-        cpu_id = get_free_cpu(container_ls, cpu_range)  # type: ignore
-        while cpu_id is None:
-            time.sleep(10)
-            remove_exited_container(container_ls)
-            cpu_id = get_free_cpu(container_ls, cpu_range)  # type: ignore
-        container = docker.from_env().containers.run(
-            image=get_target_image_name(base_image, item.target),
-            command=f"-c '${{SRC}}/script.sh'",
-            # command=f"-c bash",
-            cap_add=["SYS_PTRACE"],
-            cpuset_cpus=cpu_id,
-            detach=True,
-            name=f"{base_image}-{item.fuzzer}-{item.target}-{item.idx}",
-            network_mode="none",
-            privileged=True,
-            tty=True,
-            security_opt=["seccomp=unconfined"],
-            environment={
-                "DST": "/dst",
-                **environment,
-            },
-            volumes={
-                item.path.as_posix(): {"bind": "/shared", "mode": "rw"},
-                dst_path.as_posix(): {"bind": "/dst", "mode": "rw"},
-                (
-                    Path(__file__).parent.parent.absolute()
-                    / "fuzzers"
-                    / base_image
-                    / "run.sh"
-                ).as_posix(): {
-                    "bind": "/src/script.sh",
-                    "mode": "ro",
-                },
-            },  # type: ignore
-            labels={
-                "fuzzer": item.fuzzer,
-                "target": item.target,
-                "idx": item.idx,
-                "dst_path": dst_path.as_posix(),
-            },
-            user=f"{os.getuid()}:{os.getgid()}",
+    for host, backend in zip(hosts, dispatcher.backends):
+        for target in set([_.target for _ in todo_ls]):
+            assert backend.is_image_exist(
+                base_image, target
+            ), f"{get_target_image_name(base_image, target)} not found on {host.name}"
+    estimator = monitor = None
+    if memory is not None:
+        estimator = MemoryEstimator(work_dir, memory, sub_dir)
+        monitor = MemoryMonitor(dispatcher, memory.interval)
+        dispatcher.on_release.append(
+            lambda container: estimator.record(
+                base_image,
+                container.labels["target"],
+                monitor.pop_peak(container.id),
+            )
         )
-        container_ls.append(container)
-    # allocate more cpu
-    while True:
-        remove_exited_container(container_ls)
-        if not container_ls:
-            break
-        cpu_id = get_free_cpu(container_ls, cpu_range)  # type: ignore
-        if not cpu_id:
-            time.sleep(10)
-            continue
-        cpu_bindings = {}
-        for container in container_ls:
-            container.reload()
-            cpuset_cpus = container.attrs["HostConfig"]["CpusetCpus"].split(",")
-            cpu_bindings[container.id] = {
-                "container": container,
-                "cpus": cpuset_cpus,
-                "cpu_count": len(cpuset_cpus),
-            }
-        min_cpu_container = min(cpu_bindings.values(), key=lambda x: x["cpu_count"])
-        min_cpu_container["cpus"].append(cpu_id)
-        try:
-            min_cpu_container["container"].update(
-                cpuset_cpus=",".join(min_cpu_container["cpus"])
+    dispatcher.start()
+    if monitor is not None:
+        monitor.start()
+    script = FUZZERS_DIR / base_image / "run.sh"
+    if pool:
+        worker_pool = WorkerPool(work_dir, sub_dir, todo_ls)
+        get_item = worker_pool.get_item
+        worker_counts = worker_pool.get_worker_counts(dispatcher.slot_count)
+        # one worker per target first, then round robin up to its count
+        for n in range(max(worker_counts.values())):
+            for target in worker_counts:
+                if n >= worker_counts[target] or not worker_pool.get_queued(target):
+                    continue
+                mem = estimator.estimate(base_image, target) if estimator else 0
+                host_idx, slots = dispatcher.acquire(memory=mem)
+                worker = f"{base_image}-worker-{target}-{n}"
+                container = dispatcher.backends[host_idx].launch(
+                    RunSpec(
+                        name=worker,
+                        fuzzer=base_image,
+                        target=target,
+                        script=WORKER_SCRIPT,
+                        cpuset=",".join(slots),
+                        volumes={
+                            "/work": work_dir,
+                            "/jobs": worker_pool.get_jobs_dir(target),
+                            "/src/run.sh": script,
+                            **volumes,
+                        },
+                        environment={
+                            "WORK": "/work",
+                            "SUB_DIR": sub_dir,
+                            "JOBS": "/jobs",
+                            "WORKER": worker,
+                            "RUN_SCRIPT": "/src/run.sh",
+                            **environment,
+                        },
+                        labels={"target": target, "worker": worker},
+                    ),
+                    resume=True,
+                )
+                dispatcher.register(host_idx, container, slots, mem)
+                worker_pool.workers[container.id] = (target, worker)
+    else:
+        items: dict[str, WorkDirItem] = {}
+        get_item = items.get
+        for item in todo_ls:
+            dst_path = work_dir / sub_dir / item.fuzzer / item.target / item.idx
+            dst_path.mkdir(parents=True, exist_ok=True)
+            # admission only, the need of a run grows with the cpus it is given
+            mem = estimator.estimate(base_image, item.target) if estimator else 0
+            host_idx, slots = dispatcher.acquire(memory=mem)
+            container = dispatcher.backends[host_idx].launch(
+                RunSpec(
+                    name=f"{base_image}-{item.fuzzer}-{item.target}-{item.idx}",
+                    fuzzer=base_image,
+                    target=item.target,
+                    script=script,
+                    cpuset=",".join(slots),
+                    volumes={"/shared": item.path, "/dst": dst_path, **volumes},
+                    environment={
+                        "DST": "/dst",
+                        "ITEM": f"{item.fuzzer}/{item.target}/{item.idx}",
+                        **environment,
+                    },
+                    labels={
+                        "fuzzer": item.fuzzer,
+                        "target": item.target,
+                        "idx": item.idx,
+                        "dst_path": dst_path.as_posix(),
+                    },
+                )
             )
-        # in case of container not running
-        except APIError:
-            pass
-        except:
-            raise
+            dispatcher.register(host_idx, container, slots, mem)
+            items[container.id] = item
+    # rebalance the cpus only when a run exits or reports progress
+    changed = threading.Event()
+    changed.set()
+    dispatcher.on_release.append(lambda container: changed.set())
+    stopped = threading.Event()
+
+    def on_progress(item_key: str):
+        work.invalidate(item_key)
+        changed.set()
+        dispatcher.notify()
+
+    watcher = None
+    if progress_handler is not None:
+        watcher = threading.Thread(
+            target=_watch_progress,
+            args=(progress_handler, on_progress, stopped),
+            daemon=True,
+        )
+        watcher.start()
+    try:
+        while dispatcher.containers:
+            if changed.is_set():
+                changed.clear()
+                _rebalance(dispatcher, get_item, work.get)
+            dispatcher.wait_exited()
+    finally:
+        stopped.set()
+        if watcher is not None:
+            watcher.join()
+    dispatcher.wait()
+    if monitor is not None:
+        monitor.close()
+    if pool:
+        worker_pool.close()
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+from .utils import get_target_image_name, read_run_stats, size_to_bytes
+
+MEMORY_NAME = "memory.json"
+# runs sampled at once, a stats call takes a second or two per container
+MAX_SAMPLERS = 16
+
+
+class MemoryPolicy(NamedTuple):
+    # target -> memory of one run, e.g. {"imagemagick": "8g"}, it overrides
+    # what was learned from the peaks of past runs
+    budgets: dict[str, str] | None = None
+    # estimate of a target that has neither a budget nor a past run
+    default: str = "2g"
+    # headroom on top of the learned peak
+    margin: float = 0.25
+    # share of the memory of a host that the runs may reserve
+    host_fraction: float = 0.9
+    # seconds between two memory samples of the running runs
+    interval: int = 30
+    # whether runs get a hard limit of their estimate, docker only
+    enforce: bool = True
+
+
+def get_peak_rss(path: str | Path) -> int:
+    # afl++ reports the peak rss of the target in fuzzer_stats
+    stats = read_run_stats(path)
+    if stats is None or "peak_rss_mb" not in stats:
+        return 0
+    try:
+        return int(float(stats["peak_rss_mb"]) * 1024**2)
+    except ValueError:
+        return 0
+
+
+class MemoryEstimator:
+    def __init__(
+        self, work_dir: str | Path, policy: MemoryPolicy, sub_dir: str | None = None
+    ):
+        # the runs of make() keep their own peaks, a casr-san pool says
+        # nothing about a fuzzer on the same target and the other way round
+        name = MEMORY_NAME if sub_dir is None else f"memory_{sub_dir}.json"
+        self.path = Path(work_dir).absolute() / name
+        self.policy = policy
+        # image name -> largest peak seen so far, in bytes
+        self.peaks: dict[str, int] = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.peaks = json.load(f)
+        self._lock = threading.Lock()
+
+    def estimate(self, fuzzer: str, target: str) -> int:
+        budgets = self.policy.budgets or {}
+        if target in budgets:
+            return size_to_bytes(budgets[target])
+        peak = self._get_peak(fuzzer, target)
+        if peak is None:
+            return size_to_bytes(self.policy.default)
+        return int(peak * (1 + self.policy.margin))
+
+    def limit(self, fuzzer: str, target: str) -> int | None:
+        # a guessed default is only used for admission, a hard limit
+        # would kill the first run of a target that needs more
+        if not self.policy.enforce:
+            return None
+        if target not in (self.policy.budgets or {}):
+            if get_target_image_name(fuzzer, target) not in self.peaks:
+                return None
+        return self.estimate(fuzzer, target)
+
+    def _get_peak(self, fuzzer: str, target: str) -> int | None:
+        peak = self.peaks.get(get_target_image_name(fuzzer, target))
+        if peak is None:
+            # another fuzzer on the same target is the next best guess
+            peak = max(
+                (
+                    value
+                    for key, value in self.peaks.items()
+                    if key.split(":", 1)[-1] == target
+                ),
+                default=None,
+            )
+        return peak
+
+    def record(self, fuzzer: str, target: str, peak: int):
+        if peak <= 0:
+            return
+        image_name = get_target_image_name(fuzzer, target)
+        with self._lock:
+            self.peaks[image_name] = max(self.peaks.get(image_name, 0), peak)
+            self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.peaks, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+
+class MemoryMonitor:
+    def __init__(self, scheduler, interval: int = 30):
+        # scheduler is a Dispatcher or a single backend
+        self.scheduler = scheduler
+        self.interval = interval
+        # run id -> largest memory usage sampled so far, in bytes
+        self.peaks: dict[str, int] = {}
+        self._closed = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def close(self):
+        self._closed.set()
+
+    def _get_backends(self) -> list:
+        return getattr(self.scheduler, "backends", [self.scheduler])
+
+    def _watch(self):
+        with ThreadPoolExecutor(MAX_SAMPLERS) as executor:
+            while not self._closed.wait(self.interval):
+                futures = [
+                    executor.submit(self.sample, backend, container_id, container)
+                    for backend in self._get_backends()
+                    for container_id, container in list(backend.containers.items())
+                ]
+                for future in futures:
+                    future.result()
+
+    def sample(self, backend, container_id: str, container):
+        try:
+            usage = backend.get_memory_usage(container)
+        except Exception:
+            # the run is gone already
+            return
+        if usage is not None:
+            self.peaks[container_id] = max(self.peaks.get(container_id, 0), usage)
+
+    def pop_peak(self, container_id: str) -> int:
+        return self.peaks.pop(container_id, 0)
@@ -0,0 +1,244 @@
+import queue
+import threading
+from typing import Callable
+
+from docker.errors import APIError, NotFound
+from docker.models.containers import Container
+
+from .session import DockerSession
+
+# "oom" is left out, it is sent whenever a process of the container is
+# killed for memory, e.g. a child of afl-fuzz, and the container keeps running
+CONTAINER_EXIT_EVENTS = ["die", "stop"]
+# seconds between SIGTERM and SIGKILL when a run is stopped
+STOP_TIMEOUT = 10
+# exit events kept for runs that are not registered yet
+MAX_EARLY_EXITS = 1024
+
+
+def get_stop_timeout(container) -> int:
+    # a run with its output in a tmpfs syncs it back once it is stopped
+    return int(container.labels.get("stop_timeout", STOP_TIMEOUT))
+
+
+class SlotScheduler:
+    def __init__(
+        self,
+        cpu_slots: list[list[str]],
+        *,
+        reconcile_interval: int = 60,
+        exited: queue.Queue | None = None,
+    ):
+        assert cpu_slots, "cpu_slots should contain one element at least"
+        self.slot_order = {",".join(slot): i for i, slot in enumerate(cpu_slots)}
+        self.free_slots: list[str] = list(self.slot_order)
+        # run id -> slots the run is pinned to, a run may grow beyond one slot
+        self.cpu_bindings: dict[str, list[str]] = {}
+        # run id -> bytes of memory admitted for the run
+        self.memory_reserved: dict[str, int] = {}
+        self.containers: dict = {}
+        self.on_release: list[Callable] = []
+        self.reconcile_interval = reconcile_interval
+        # several schedulers may share one queue, see dispatch.Dispatcher
+        if exited is None:
+            exited = queue.Queue()
+        self._exited: queue.Queue[str] = exited
+        # an exit may be seen before register(), the exits of other
+        # containers of the host end up here as well, the oldest are dropped
+        self._early_exits: dict[str, None] = {}
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _reconcile(self):
+        pass
+
+    def _before_release(self, container):
+        pass
+
+    def _remove(self, container):
+        pass
+
+    def _stop(self, container):
+        container.stop(timeout=get_stop_timeout(container))
+
+    def update_cpuset(self, container, cpuset: str):
+        # a backend that can not re-pin its runs keeps their first cpus
+        pass
+
+    def get_memory_total(self) -> int | None:
+        return None
+
+    def get_memory_usage(self, container) -> int | None:
+        return None
+
+    @property
+    def memory_used(self) -> int:
+        return sum(self.memory_reserved.values())
+
+    def wait_exited(self):
+        try:
+            container_id = self._exited.get(timeout=self.reconcile_interval)
+        except queue.Empty:
+            self._reconcile()
+            return
+        self.release(container_id)
+
+    def get_cpuset(self, container_id: str) -> str:
+        return ",".join(self.cpu_bindings[container_id])
+
+    def register(self, container, slots: list[str], memory: int = 0):
+        self.containers[container.id] = container
+        self.cpu_bindings[container.id] = list(slots)
+        self.memory_reserved[container.id] = memory
+        if container.id in self._early_exits:
+            del self._early_exits[container.id]
+            self._exited.put(container.id)
+
+    def release(self, container_id: str):
+        # several events arrive for one exit, only the first one counts
+        container = self.containers.pop(container_id, None)
+        if container is None:
+            self._early_exits[container_id] = None
+            if len(self._early_exits) > MAX_EARLY_EXITS:
+                del self._early_exits[next(iter(self._early_exits))]
+            return
+        self.free_slots.extend(self.cpu_bindings.pop(container_id))
+        self.free_slots.sort(key=lambda x: self.slot_order[x])
+        self.memory_reserved.pop(container_id, None)
+        self._before_release(container)
+        for callback in self.on_release:
+            callback(container)
+        self._remove(container)
+
+    def grow(self, container_id: str) -> bool:
+        if not self.free_slots or container_id not in self.containers:
+            return False
+        slot = self.free_slots.pop(0)
+        self.cpu_bindings[container_id].append(slot)
+        self.update_cpuset(self.containers[container_id], self.get_cpuset(container_id))
+        return True
+
+    def shrink(self, container_id: str) -> bool:
+        # keep the first slot only, the others go back to the pool
+        slots = self.cpu_bindings.get(container_id)
+        if not slots or len(slots) == 1:
+            return False
+        self.free_slots.extend(slots[1:])
+        self.free_slots.sort(key=lambda x: self.slot_order[x])
+        del slots[1:]
+        self.update_cpuset(self.containers[container_id], self.get_cpuset(container_id))
+        return True
+
+    def acquire(self, count: int = 1) -> list[str]:
+        assert count <= len(self.slot_order), f"only {len(self.slot_order)} slots"
+        while len(self.free_slots) < count:
+            self.wait_exited()
+        slots, self.free_slots = self.free_slots[:count], self.free_slots[count:]
+        return slots
+
+    def wait(self):
+        while self.containers:
+            self.wait_exited()
+        self.close()
+
+    def stop(self):
+        for container in list(self.containers.values()):
+            self._stop(container)
+            self._remove(container)
+        self.containers.clear()
+        self.cpu_bindings.clear()
+        self.memory_reserved.clear()
+        self.close()
+
+
+class ContainerScheduler(SlotScheduler):
+    def __init__(
+        self,
+        session: DockerSession,
+        cpu_slots: list[list[str]],
+        *,
+        reconcile_interval: int = 60,
+        exited: queue.Queue | None = None,
+    ):
+        super().__init__(
+            cpu_slots, reconcile_interval=reconcile_interval, exited=exited
+        )
+        self.session = session
+        self.containers: dict[str, Container] = {}
+        self._events = None
+
+    def start(self):
+        # subscribe before the first container starts so no exit is missed
+        self._events = self.session.client.events(
+            decode=True,
+            filters={"type": "container", "event": CONTAINER_EXIT_EVENTS},
+        )
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def close(self):
+        if self._events is not None:
+            self._events.close()
+            self._events = None
+
+    def _watch(self):
+        try:
+            for event in self._events:
+                action = event.get("Action") or event.get("status")
+                if action not in CONTAINER_EXIT_EVENTS:
+                    continue
+                container_id = event.get("id") or event.get("Actor", {}).get("ID")
+                if container_id:
+                    self._exited.put(container_id)
+        except Exception:
+            # the stream is gone, acquire() falls back to _reconcile()
+            pass
+
+    def _reconcile(self):
+        for container_id, container in list(self.containers.items()):
+            try:
+                container.reload()
+            except NotFound:
+                self._exited.put(container_id)
+                continue
+            if container.status == "exited":
+                self._exited.put(container_id)
+
+    def _remove(self, container: Container):
+        self.session.remove_container(container, force=True)
+
+    def _stop(self, container: Container):
+        try:
+            container.stop(timeout=get_stop_timeout(container))
+        except NotFound:
+            pass
+
+    def update_cpuset(self, container: Container, cpuset: str):
+        try:
+            container.update(cpuset_cpus=cpuset)
+        # in case of container not running
+        except APIError:
+            pass
+
+    def get_memory_total(self) -> int | None:
+        return self.session.info.get("MemTotal")
+
+    def get_memory_usage(self, container: Container) -> int | None:
+        if self.session.is_one_shot_stats:
+            stats = container.stats(stream=False, one_shot=True)
+        else:
+            stats = container.stats(stream=False)
+        memory_stats = stats.get("memory_stats", {})
+        usage = memory_stats.get("usage")
+        if usage is None:
+            return None
+        # page cache of the output dir is not what the run needs, the key
+        # is total_inactive_file on cgroup v1 and inactive_file on v2
+        cgroup_stats = memory_stats.get("stats", {})
+        cache = cgroup_stats.get(
+            "total_inactive_file", cgroup_stats.get("inactive_file", 0)
+        )
+        return max(usage - cache, 0)
@@ -0,0 +1,136 @@
+import os
+
+import docker
+from docker.errors import APIError, NotFound
+from docker.models.containers import Container
+
+MAX_POOL_SIZE = 64
+# hash of the build inputs of an image, see build.get_fuzzer_hash
+HASH_LABEL = "fuzzdeploy.hash"
+
+
+class DockerSession:
+    def __init__(
+        self, base_url: str | None = None, images: dict[str, str | None] | None = None
+    ):
+        self.base_url = base_url
+        if base_url is None:
+            self.client = docker.from_env(max_pool_size=MAX_POOL_SIZE)
+        else:
+            self.client = docker.DockerClient(
+                base_url=base_url, max_pool_size=MAX_POOL_SIZE
+            )
+        self.containers: dict[str, Container] = {}
+        # image tag -> hash of its build inputs
+        self._images = images
+        self._info = None
+
+    @property
+    def info(self) -> dict:
+        if self._info is None:
+            self._info = self.client.info()
+        return self._info
+
+    @property
+    def ncpu(self) -> int:
+        return int(self.info.get("NCPU"))
+
+    @property
+    def is_one_shot_stats(self) -> bool:
+        # stats without the second sample for the cpu usage, api 1.41+
+        return not docker.utils.version_lt(self.client.api.api_version, "1.41")
+
+    def refresh_images(self):
+        images = {}
+        for image in self.client.images.list():
+            for tag in image.tags:
+                images[tag] = image.labels.get(HASH_LABEL)
+        self._images = images
+
+    def is_image_exist(self, image_name: str) -> bool:
+        if self._images is None:
+            self.refresh_images()
+        if image_name in self._images:  # type: ignore
+            return True
+        # an image id or a name without a tag, resolved by docker
+        try:
+            self.client.images.get(image_name)
+        except APIError:
+            return False
+        return True
+
+    def get_image_hash(self, image_name: str) -> str | None:
+        if self._images is None:
+            self.refresh_images()
+        return self._images.get(image_name)  # type: ignore
+
+    def add_image(self, image_name: str, image_hash: str | None = None):
+        if self._images is not None:
+            self._images[image_name] = image_hash
+
+    def remove_image(self, image_name: str):
+        try:
+            self.client.images.remove(image_name, force=True)
+        except APIError:
+            pass
+        if self._images is not None:
+            self._images.pop(image_name, None)
+
+    def prune_images(self) -> int:
+        # images of ours that lost their tag to a rebuild
+        result = self.client.images.prune(
+            filters={"dangling": True, "label": HASH_LABEL}
+        )
+        return result.get("SpaceReclaimed") or 0
+
+    def run_container(self, **kwargs) -> Container:
+        container = self.client.containers.run(**kwargs)
+        self.containers[container.id] = container  # type: ignore
+        return container  # type: ignore
+
+    def create_container(self, **kwargs) -> Container:
+        container = self.client.containers.create(**kwargs)
+        self.containers[container.id] = container  # type: ignore
+        return container  # type: ignore
+
+    def remove_stale_container(self, name: str):
+        try:
+            self.client.containers.get(name).remove(force=True)
+        except NotFound:
+            pass
+
+    def remove_stale_volume(self, name: str):
+        try:
+            self.client.volumes.get(name).remove(force=True)
+        except NotFound:
+            pass
+
+    def remove_container(self, container: Container, force: bool = False):
+        self.containers.pop(container.id, None)  # type: ignore
+        try:
+            container.remove(force=force)
+        except NotFound:
+            pass
+
+
+_sessions: dict[str | None, DockerSession] = {}
+_sessions_pid: int | None = None
+
+
+def get_session(base_url: str | None = None) -> DockerSession:
+    global _sessions_pid
+    if _sessions_pid != os.getpid():
+        # a forked worker must not reuse the parent's connections,
+        # but it can inherit the image inventory the parent refreshed
+        inherited = {
+            url: dict(session._images)
+            for url, session in _sessions.items()
+            if session._images is not None
+        }
+        _sessions.clear()
+        for url, images in inherited.items():
+            _sessions[url] = DockerSession(base_url=url, images=images)
+        _sessions_pid = os.getpid()
+    if base_url not in _sessions:
+        _sessions[base_url] = DockerSession(base_url=base_url)
+    return _sessions[base_url]
@@ -0,0 +1,168 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import NamedTuple
+
+MANIFEST_NAME = "manifest.json"
+# the repo urls a fetch.sh clones
+CLONE_URL = re.compile(
+    r"git\s+clone\b[^\n]*?[\s\"']((?:https?|git|ssh|file)://[^\s\"']+|git@[^\s\"']+)"
+)
+# a fetch.sh that checks out a revision does not follow its upstream
+PINNED = re.compile(r"\bgit\b[^\n]*\b(?:checkout|reset)\b")
+
+
+class SourceCache(NamedTuple):
+    # host dir of the fetched sources, <path>/<fuzzers|targets>/<name>/<key>
+    path: str | Path = Path.home() / ".cache" / "fuzzdeploy" / "sources"
+    # build from the cache only, a source that is not cached fails the build
+    offline: bool = False
+    # check the cached sources against their digest before every build
+    verify: bool = False
+
+
+def get_remote_heads(script: str, resolve: bool = True) -> list[str] | None:
+    # the current heads of the repos an unpinned fetch.sh clones, None when
+    # they are not resolved, e.g. offline
+    if PINNED.search(script):
+        return []
+    urls = CLONE_URL.findall(script)
+    if urls and not resolve:
+        return None
+    heads = []
+    for url in urls:
+        try:
+            output = subprocess.run(
+                ["git", "ls-remote", url, "HEAD"],
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                text=True,
+                timeout=60,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        if output.returncode != 0 or not output.stdout.split():
+            return None
+        heads.append(output.stdout.split()[0])
+    return heads
+
+
+def get_fetch_key(src: Path, heads: list[str] | None = None) -> str:
+    # fetch.sh holds the url and the revision of a pinned source, the heads
+    # of its upstream repos stand in for the revision of an unpinned one
+    key = hashlib.sha256((src / "fetch.sh").read_bytes()).hexdigest()[:16]
+    if not heads:
+        return key
+    return f"{key}-{hashlib.sha256(' '.join(heads).encode()).hexdigest()[:16]}"
+
+
+def _get_latest_entry(parent: Path, key: str) -> Path | None:
+    # the last fetch of an unpinned source whose heads are unknown
+    entries = [
+        p
+        for p in parent.iterdir()
+        if p.is_dir() and (p.name == key or p.name.startswith(f"{key}-"))
+    ]
+    if not entries:
+        return None
+    return max(entries, key=lambda p: p.stat().st_mtime)
+
+
+def get_tree_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        root = Path(root)
+        for name in sorted(files) + [_ for _ in dirs if (root / _).is_symlink()]:
+            item = root / name
+            h.update(item.relative_to(path).as_posix().encode() + b"\0")
+            if item.is_symlink():
+                h.update(os.readlink(item).encode())
+            elif item.is_file():
+                with open(item, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        h.update(chunk)
+            h.update(b"\0")
+    return h.hexdigest()
+
+
+def _fetch(src: Path, var: str, entry: Path, log_path: Path) -> bool:
+    # fetch.sh leaves the source in $FUZZER/repo or $TARGET/repo, the image
+    # skips its own fetch once the repo is in the build context
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".fetch-", dir=entry.parent))
+    try:
+        shutil.copy2(src / "fetch.sh", tmp_dir / "fetch.sh")
+        work_dir = tmp_dir / "work"
+        work_dir.mkdir()
+        with open(log_path, "w") as f:
+            code = subprocess.call(
+                ["bash", (tmp_dir / "fetch.sh").as_posix()],
+                cwd=work_dir,
+                env={**os.environ, var: tmp_dir.as_posix()},
+                stdin=subprocess.DEVNULL,
+                stdout=f,
+                stderr=subprocess.STDOUT,
+            )
+        if code != 0:
+            return False
+        repo = tmp_dir / "repo"
+        manifest = {
+            "repo": repo.exists(),
+            "digest": get_tree_digest(repo) if repo.exists() else None,
+        }
+        with open(tmp_dir / MANIFEST_NAME, "w") as f:
+            json.dump(manifest, f, indent=4)
+        (tmp_dir / "fetch.sh").unlink()
+        shutil.rmtree(work_dir)
+        os.replace(tmp_dir, entry)
+        return True
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def get_source(
+    cache: SourceCache, src: Path, var: str, log_path: Path
+) -> tuple[bool, Path | None]:
+    # returns whether the source is available and the repo dir to put into
+    # the build context, None if fetch.sh fetches nothing
+    if not (src / "fetch.sh").exists():
+        return True, None
+    kind = "fuzzers" if var == "FUZZER" else "targets"
+    heads = get_remote_heads(
+        (src / "fetch.sh").read_text(errors="replace"), resolve=not cache.offline
+    )
+    entry = Path(cache.path).absolute() / kind / src.name / get_fetch_key(src, heads)
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    # builds of several fuzzers fetch the same target at the same time
+    with open(entry.parent / ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if heads is None:
+            entry = _get_latest_entry(entry.parent, get_fetch_key(src)) or entry
+        if (entry / MANIFEST_NAME).exists():
+            with open(entry / MANIFEST_NAME) as f:
+                manifest = json.load(f)
+            repo = entry / "repo" if manifest["repo"] else None
+            if not cache.verify or repo is None:
+                return True, repo
+            if get_tree_digest(repo) == manifest["digest"]:
+                return True, repo
+            print(f"{repo} does not match its digest")
+            if cache.offline:
+                return False, None
+            shutil.rmtree(entry)
+        elif cache.offline:
+            print(f"{kind}/{src.name} is not in {cache.path}")
+            return False, None
+        if not _fetch(src, var, entry, log_path):
+            return False, None
+        # the sources of an older fetch.sh
+        for stale in entry.parent.iterdir():
+            if stale.is_dir() and stale != entry and not stale.name.startswith("."):
+                shutil.rmtree(stale, ignore_errors=True)
+        return True, entry / "repo" if (entry / "repo").exists() else None
@@ -2,4 +2,111 @@
 set -e
 
 export TAEGET_ARGS=${PROGRAM}/$(cat "$TARGET/target_args")
-bash "$FUZZER/run.sh" | tee "$SHARED/output.log"
+# "-" resumes in place from the output dir of a previous session
+export CORPUS=${CORPUS:-$TARGET/corpus}
+INSTANCES=${INSTANCES:-1}
+
+# $SHARED is a tmpfs when $ARCHIVE is set, the files worth keeping are
+# copied to $ARCHIVE every $SYNC_INTERVAL seconds and once more at exit
+sync_archive() {
+    for dir in "$SHARED" "$SHARED"/*/; do
+        dir=${dir%/}
+        [ -d "$dir/queue" ] || [ "$dir" == "$SHARED" ] || continue
+        dst="$ARCHIVE/${dir#"$SHARED"}"
+        mkdir -p "$dst"
+        for name in queue crashes hangs crashes.* hangs.* plot_data fuzzer_setup cmdline fuzzer_stats; do
+            if [ -e "$dir/$name" ]; then
+                cp -ru --preserve=timestamps "$dir/$name" "$dst"/
+            fi
+        done
+    done
+    for log in "$SHARED"/output*.log "$SHARED"/output*.log.*.gz; do
+        if [ -e "$log" ]; then
+            cp -u --preserve=timestamps "$log" "$ARCHIVE"/
+        fi
+    done
+}
+
+# appends stdin to the log $1 and echoes it like tee, see logcap.LogPolicy:
+# a status frame is kept once per $LOG_FRAME_INTERVAL seconds and the log is
+# rotated into $1.1.gz .. $1.$LOG_BACKUPS.gz when it reaches $LOG_MAX_SIZE
+capture_log() {
+    local size awk=(awk)
+    size=$(stat -c %s "$1" 2>/dev/null || echo 0)
+    # mawk, the awk of the ubuntu images, holds a piped stdin until EOF and
+    # the timeout or stop that ends every run would kill it with those lines
+    if awk -W version 2>&1 | grep -q mawk; then
+        awk=(awk -W interactive)
+    fi
+    LC_ALL=C "${awk[@]}" -v path="$1" -v size="$size" -v max_size="${LOG_MAX_SIZE:-16777216}" \
+        -v backups="${LOG_BACKUPS:-3}" -v interval="${LOG_FRAME_INTERVAL:-60}" '
+        function now() { srand(); return srand() }
+        function rotate(i) {
+            close(path)
+            for (i = backups - 1; i >= 1; i--) {
+                system("[ ! -e \"" path "." i ".gz\" ] || mv -f \"" path "." i ".gz\" \"" path "." (i + 1) ".gz\"")
+            }
+            if (backups > 0) {
+                system("gzip -c \"" path "\" > \"" path ".1.gz\"")
+            }
+            system("rm -f \"" path "\"")
+            size = 0
+        }
+        BEGIN { last = -interval; keep = 1 }
+        {
+            if ($0 ~ /\033\[H|\033\[2J|\r/) {
+                t = now()
+                keep = t - last >= interval
+                if (keep) last = t
+            }
+            # the rest of a frame goes with its first line
+            if ($0 ~ /\033|\r/ && !keep) next
+            print
+            fflush()
+            print >> path
+            fflush(path)
+            # bytes, not characters, awk runs with LC_ALL=C
+            size += length($0) + 1
+            if (size >= max_size) rotate()
+        }'
+}
+
+cleanup() {
+    jobs -p | xargs -r kill 2>/dev/null || true
+    if [ -n "$ARCHIVE" ]; then
+        sync_archive || true
+    fi
+}
+trap cleanup EXIT
+trap 'exit 143' TERM INT
+
+if [ -n "$ARCHIVE" ]; then
+    if [ "$CORPUS" == "-" ]; then
+        # resume from the archive, its crashes and hangs are set aside like
+        # afl does in place so that the new ones do not overwrite them
+        for dir in "$ARCHIVE" "$ARCHIVE"/*/; do
+            for name in crashes hangs; do
+                if [ -d "${dir%/}/$name" ]; then
+                    mv "${dir%/}/$name" "${dir%/}/$name.$(date +%Y-%m-%d-%H:%M:%S)"
+                fi
+            done
+        done
+        (cd "$ARCHIVE" && tar -cf - --exclude="./crashes*" --exclude="./hangs*" \
+            --exclude="./*/crashes*" --exclude="./*/hangs*" .) | (cd "$SHARED" && tar -xf -)
+    fi
+    (while sleep "${SYNC_INTERVAL:-300}"; do sync_archive || true; done) &
+fi
+
+if [ "$INSTANCES" -le 1 ]; then
+    bash "$FUZZER/run.sh" 2>&1 | capture_log "$SHARED/output.log"
+    exit
+fi
+# one main and INSTANCES-1 secondaries syncing through $SHARED
+secondaries=()
+for i in $(seq 2 "$INSTANCES"); do
+    FUZZER_ARGS="$FUZZER_ARGS -S secondary$i" bash "$FUZZER/run.sh" 2>&1 |
+        capture_log "$SHARED/output-secondary$i.log" >/dev/null &
+    secondaries+=($!)
+done
+FUZZER_ARGS="$FUZZER_ARGS -M main" bash "$FUZZER/run.sh" 2>&1 | capture_log "$SHARED/output.log"
+wait "${secondaries[@]}"
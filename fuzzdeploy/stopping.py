@@ -0,0 +1,130 @@
+import datetime
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+from docker.errors import APIError, NotFound
+
+from .dispatch import Dispatcher
+from .scheduler import SlotScheduler, get_stop_timeout
+from .utils import read_run_stats, time_to_seconds
+
+STOP_REASON_FILE = "stop_reason"
+
+
+class StopRule(NamedTuple):
+    # stop when no new edge was found for this long, e.g. "2h"
+    plateau: str | None = None
+    # stop when this many unique crashes were saved
+    crashes: int | None = None
+    # stop when bitmap_cvg reaches this percentage
+    bitmap_cvg: float | None = None
+    # seconds between two checks of fuzzer_stats
+    interval: int = 60
+
+
+def _get_float(stats: dict[str, str], *keys: str) -> float | None:
+    for key in keys:
+        if key in stats:
+            try:
+                return float(stats[key].rstrip("%"))
+            except ValueError:
+                return None
+    return None
+
+
+def _stop_container(container):
+    try:
+        container.stop(timeout=get_stop_timeout(container))
+    except (APIError, NotFound):
+        pass
+
+
+class EarlyStopper:
+    def __init__(
+        self,
+        scheduler: SlotScheduler | Dispatcher,
+        work_dir: Path,
+        rule: StopRule,
+    ):
+        assert (
+            rule.plateau or rule.crashes is not None or rule.bitmap_cvg is not None
+        ), "stop rule should contain one condition at least"
+        self.scheduler = scheduler
+        self.work_dir = work_dir
+        self.rule = rule
+        self.plateau = time_to_seconds(rule.plateau) if rule.plateau else None
+        # container id -> (edges, time the edges last changed)
+        self.edges: dict[str, tuple[float, float]] = {}
+        self.stopped: set[str] = set()
+        self._closed = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def close(self):
+        self._closed.set()
+
+    def _watch(self):
+        while not self._closed.wait(self.rule.interval):
+            for container_id, container in list(self.scheduler.containers.items()):
+                if container_id in self.stopped:
+                    continue
+                labels = container.labels
+                path = (
+                    self.work_dir
+                    / "archive"
+                    / labels["fuzzer"]
+                    / labels["target"]
+                    / labels["idx"]
+                )
+                reason = self.get_stop_reason(container_id, path)
+                if reason is not None:
+                    self.stopped.add(container_id)
+                    self.stop(container, path, reason)
+            for container_id in list(self.edges):
+                if container_id not in self.scheduler.containers:
+                    self.edges.pop(container_id)
+            self.stopped &= set(self.scheduler.containers)
+
+    def get_stop_reason(self, container_id: str, path: Path) -> str | None:
+        stats = read_run_stats(path)
+        if stats is None:
+            return None
+        crashes = _get_float(stats, "saved_crashes", "unique_crashes")
+        if self.rule.crashes is not None and crashes is not None:
+            if crashes >= self.rule.crashes:
+                return f"crashes: {int(crashes)} >= {self.rule.crashes}"
+        bitmap_cvg = _get_float(stats, "bitmap_cvg")
+        if self.rule.bitmap_cvg is not None and bitmap_cvg is not None:
+            if bitmap_cvg >= self.rule.bitmap_cvg:
+                return f"bitmap_cvg: {bitmap_cvg}% >= {self.rule.bitmap_cvg}%"
+        edges = _get_float(stats, "edges_found", "bitmap_cvg")
+        if self.plateau is not None and edges is not None:
+            now = time.time()
+            last_edges, last_change = self.edges.get(container_id, (None, now))
+            if edges != last_edges:
+                last_change = now
+            self.edges[container_id] = (edges, last_change)
+            if now - last_change >= self.plateau:
+                return f"plateau: no new edges for {self.rule.plateau}"
+        return None
+
+    def stop(self, container, path: Path, reason: str):
+        with open(path / STOP_REASON_FILE, "w") as f:
+            f.write(
+                f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {reason}\n"
+            )
+        print(
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            container.short_id,
+            container.labels["fuzzer"].ljust(16),
+            container.labels["target"].ljust(10),
+            container.labels["idx"].ljust(3),
+            "stops early,",
+            reason,
+        )
+        # a tmpfs run may take minutes to sync, the other runs are checked
+        # meanwhile and the die event hands the cpus to the next pending run
+        threading.Thread(target=_stop_container, args=(container,), daemon=True).start()
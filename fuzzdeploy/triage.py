@@ -0,0 +1,241 @@
+import fcntl
+import json
+import os
+import shutil
+from enum import Enum
+from pathlib import Path
+from typing import NamedTuple
+
+from .backend import DockerHost
+from .build import get_file_digest, get_target_hash
+from .dispatch import Host
+from .session import get_session
+from .utils import WorkDirItem, get_target_image_name, size_to_bytes
+
+# a triaged crash content is either reported or failed, see
+# fuzzers/casr/triage.py
+RESULT_SUFFIXES = (".casrep", ".failed")
+# the image the results of a store belong to
+KEY_NAME = "key"
+# one json object per line, appended by casr.get and fuzzers/casr/triage.py
+LEDGER_NAME = "ledger.jsonl"
+
+
+class CrashState(Enum):
+    PENDING = "pending"
+    REPORTED = "reported"
+    FAILED = "failed"
+    # the result of a byte-identical crash, reported or failed
+    DEDUPLICATED = "deduplicated"
+
+
+class CrashRecord(NamedTuple):
+    # <fuzzer>/<target>/<idx> of the archive item
+    item: str
+    crash: str
+    state: CrashState
+    # reported or failed, None while pending
+    result: CrashState | None = None
+
+
+def get_item_key(item: WorkDirItem) -> str:
+    return f"{item.fuzzer}/{item.target}/{item.idx}"
+
+
+class TriageLedger:
+    # the state of every crash of a work_dir, a later record of a crash
+    # replaces the earlier ones
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.offset = 0
+        self.records: dict[str, dict[str, CrashRecord]] = {}
+        self.update()
+
+    def update(self) -> list[CrashRecord]:
+        # reads the records appended since the last update only
+        if not self.path.exists():
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        # a line that is still being written is read next time
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        records = []
+        for line in data[:end].splitlines():
+            try:
+                content = json.loads(line)
+                record = CrashRecord(
+                    item=content["item"],
+                    crash=content["crash"],
+                    state=CrashState(content["state"]),
+                    result=(
+                        CrashState(content["result"]) if content.get("result") else None
+                    ),
+                )
+            except (ValueError, KeyError):
+                continue
+            self.records.setdefault(record.item, {})[record.crash] = record
+            records.append(record)
+        return records
+
+    def append(self, records: list[CrashRecord]):
+        if not records:
+            return
+        with open(self.path, "a") as f:
+            f.write(
+                "".join(
+                    json.dumps(
+                        {
+                            "item": _.item,
+                            "crash": _.crash,
+                            "state": _.state.value,
+                            "result": _.result.value if _.result else None,
+                        }
+                    )
+                    + "\n"
+                    for _ in records
+                )
+            )
+        self.update()
+
+    def get_records(self, item_key: str) -> dict[str, CrashRecord]:
+        return self.records.get(item_key, {})
+
+    def get_triaged(self, item_key: str) -> set[str]:
+        return {
+            crash
+            for crash, record in self.get_records(item_key).items()
+            if record.state != CrashState.PENDING
+        }
+
+
+class TriageCache(NamedTuple):
+    # host dir of the casr results, <path>/<target>/<image key>/<crash digest>
+    path: str | Path = Path.home() / ".cache" / "fuzzdeploy" / "casr"
+    # the least recently used results are dropped beyond it
+    max_size: str = "1g"
+
+
+def get_image_key(target: str, hosts: list[Host]) -> str:
+    # a forced rebuild may give another image from the same inputs
+    for host in hosts:
+        if isinstance(host, DockerHost):
+            return (
+                get_session(host.url)
+                .client.images.get(get_target_image_name("casr", target))
+                .id
+            )
+    # a native casr has no image, its build inputs are the next best thing
+    return get_target_hash("casr", target)
+
+
+def get_crash_digest(path: Path) -> str:
+    return get_file_digest(path).hex()
+
+
+def _put_file(src: Path, dst: Path):
+    # a hard link where possible, the cache may be on another filesystem
+    tmp = dst.with_name(f".{dst.name}.{os.getpid()}")
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _iter_results(path: Path):
+    if not path.is_dir():
+        return
+    for p in path.iterdir():
+        if p.suffix in RESULT_SUFFIXES and not p.name.startswith("."):
+            yield p
+
+
+def prepare_store(store_path: Path, key: str):
+    # the results in the store of a work_dir are stale once the image of
+    # its target was rebuilt
+    key_path = store_path / KEY_NAME
+    if key_path.exists() and key_path.read_text().strip() == key:
+        return
+    shutil.rmtree(store_path, ignore_errors=True)
+    store_path.mkdir(parents=True)
+    key_path.write_text(key)
+
+
+class _Lock:
+    # casr.get of several work_dirs may share the cache
+    def __init__(self, cache: TriageCache):
+        self.path = Path(cache.path).absolute() / ".lock"
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "w")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+
+def seed_store(
+    cache: TriageCache, store_path: Path, target: str, key: str, digests: set[str]
+) -> int:
+    # copies the cached results of the given crash contents into the store,
+    # casr-san skips them
+    entry = Path(cache.path).absolute() / target / key
+    if not entry.is_dir():
+        return 0
+    count = 0
+    with _Lock(cache):
+        for digest in digests:
+            for suffix in RESULT_SUFFIXES:
+                if (store_path / f"{digest}{suffix}").exists():
+                    break
+                cached = entry / f"{digest}{suffix}"
+                if not cached.exists():
+                    continue
+                _put_file(cached, store_path / cached.name)
+                # the mtime of an entry is its last use
+                os.utime(cached)
+                count += 1
+                break
+    return count
+
+
+def fill_cache(cache: TriageCache, store_path: Path, target: str, key: str) -> int:
+    root = Path(cache.path).absolute()
+    entry = root / target / key
+    count = 0
+    with _Lock(cache):
+        # the results of an older image of the target
+        if entry.parent.is_dir():
+            for stale in entry.parent.iterdir():
+                if stale.is_dir() and stale != entry:
+                    shutil.rmtree(stale, ignore_errors=True)
+        entry.mkdir(parents=True, exist_ok=True)
+        for p in _iter_results(store_path):
+            if not (entry / p.name).exists():
+                _put_file(p, entry / p.name)
+                count += 1
+        _evict(cache)
+    return count
+
+
+def _evict(cache: TriageCache):
+    root = Path(cache.path).absolute()
+    results = []
+    for target in root.iterdir():
+        if not target.is_dir():
+            continue
+        for entry in target.iterdir():
+            for p in _iter_results(entry):
+                stat = p.stat()
+                results.append((stat.st_mtime, stat.st_size, p))
+    size = sum(_[1] for _ in results)
+    max_size = size_to_bytes(cache.max_size)
+    for _, p_size, p in sorted(results, key=lambda x: x[0]):
+        if size <= max_size:
+            break
+        p.unlink()
+        size -= p_size
@@ -4,17 +4,11 @@ import re
 from pathlib import Path
 from typing import NamedTuple
 
-import docker
-from docker.models.containers import Container
+from .session import get_session
 
 
 def is_image_exist(image_name: str):
-    client = docker.from_env()
-    try:
-        client.images.get(image_name)
-        return True
-    except:
-        return False
+    return get_session().is_image_exist(image_name)
 
 
 def get_fuzzer_image_name(fuzzer: str):
@@ -25,6 +19,11 @@ def get_target_image_name(fuzzer: str, target: str):
     return f"{fuzzer}:{target}"
 
 
+def get_runtime_image_name(fuzzer: str, target: str):
+    # the slim image of get_target_image_name that is only good for fuzzing
+    return f"{fuzzer}-runtime:{target}"
+
+
 def get_past_sec(container) -> int:
     time_str = container.attrs["State"]["StartedAt"]
     time_str = time_str[: time_str.index(".")]
@@ -50,6 +49,21 @@ def time_to_seconds(time_str):
     return total_seconds
 
 
+def size_to_bytes(size: str | int) -> int:
+    if isinstance(size, int):
+        return size
+    size_units = {
+        "": 1,
+        "k": 1024,
+        "m": 1024**2,
+        "g": 1024**3,
+        "t": 1024**4,
+    }
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([kmgt]?)b?", size.strip().lower())
+    assert match, f"invalid size {size}"
+    return int(float(match.group(1)) * size_units[match.group(2)])
+
+
 class WorkDirItem(NamedTuple):
     fuzzer: str
     target: str
@@ -82,43 +96,126 @@ def work_dir_iterdir(work_dir: str | Path, sub_dir: str):
                 )
 
 
-def get_item_path(path: str | Path, item: str) -> Path | None:
+def get_item_paths(path: str | Path, item: str) -> list[Path]:
+    # afl writes into path itself, afl++ into path/default and
+    # parallel -M/-S instances into path/<instance>
+    res = []
     dir_ls = []
-    for p in Path(path).glob("*"):
+    for p in sorted(Path(path).glob("*")):
         if p.name == item:
-            return p
-        if p.is_dir():
+            res.append(p)
+        elif p.is_dir():
             dir_ls.append(p)
     for p in dir_ls:
-        for pp in p.glob("*"):
+        for pp in sorted(p.glob("*")):
             if pp.name == item:
-                return pp
-    return None
+                res.append(pp)
+    return res
+
+
+def get_item_path(path: str | Path, item: str) -> Path | None:
+    item_paths = get_item_paths(path, item)
+    return item_paths[0] if item_paths else None
+
+
+def get_instance_name(path: str | Path, item_path: Path) -> str | None:
+    # None when the item belongs to the only afl instance of the run
+    if item_path.parent == Path(path) or item_path.parent.name == "default":
+        return None
+    return item_path.parent.name
+
+
+def get_crashes(path: str | Path) -> dict[str, Path]:
+    # crash ids restart in every instance, the name of a crash found by
+    # a -M/-S instance is suffixed with ",instance:<name>", see casr/run.sh
+    crashes = {}
+    for crashes_path in get_item_paths(path, "crashes"):
+        instance = get_instance_name(path, crashes_path)
+        for p in crashes_path.glob("id*"):
+            if not p.is_file():
+                continue
+            name = p.name if instance is None else f"{p.name},instance:{instance}"
+            crashes[name] = p
+    return crashes
 
 
-def remove_exited_container(container_ls: list[Container]):
-    removed_container_ls = []
-    for container in container_ls:
-        container.reload()
-        if container.status == "exited":
-            container.remove()
-            removed_container_ls.append(container)
-    for container in removed_container_ls:
-        container_ls.remove(container)
-
-
-def get_free_cpu(container_ls: list[Container], cpu_range: set[str]) -> str | None:
-    used_cpu = set()
-    for container in container_ls:
-        container.reload()
-        for cpu in container.attrs["HostConfig"]["CpusetCpus"].split(","):
-            used_cpu.add(cpu)
-    for cpu in cpu_range:
-        if cpu not in used_cpu:
-            return cpu
+def get_crash_instance(crash_name: str) -> str | None:
+    for field in crash_name.split(","):
+        if field.startswith("instance:"):
+            return field.split(":", 1)[1]
     return None
 
 
+def read_fuzzer_stats(fuzzer_stats_path: str | Path) -> dict[str, str]:
+    content = Path(fuzzer_stats_path).open("r", encoding="utf-8").read()
+    stats = {}
+    for line in content.strip().split("\n"):
+        if ":" not in line:
+            continue
+        key, value = line.split(":", 1)
+        stats[key.strip()] = value.strip()
+    return stats
+
+
+FUZZER_STATS_SUM = (
+    "execs_done",
+    "execs_per_sec",
+    "corpus_count",
+    "paths_total",
+    "corpus_found",
+    "paths_found",
+    "saved_crashes",
+    "unique_crashes",
+    "saved_hangs",
+    "unique_hangs",
+    "pending_favs",
+    "pending_total",
+    "peak_rss_mb",
+)
+FUZZER_STATS_MAX = ("last_update", "bitmap_cvg", "edges_found", "max_depth")
+FUZZER_STATS_MIN = ("start_time", "execs_since_crash")
+
+
+def merge_fuzzer_stats(stats_ls: list[dict[str, str]]) -> dict[str, str]:
+    merged = dict(stats_ls[0])
+    for keys, func in (
+        (FUZZER_STATS_SUM, sum),
+        (FUZZER_STATS_MAX, max),
+        (FUZZER_STATS_MIN, min),
+    ):
+        for key in keys:
+            values = []
+            for stats in stats_ls:
+                try:
+                    values.append(float(stats[key].rstrip("%")))
+                except (KeyError, ValueError):
+                    continue
+            if not values:
+                continue
+            value = func(values)
+            if value.is_integer():
+                merged[key] = str(int(value))
+            else:
+                merged[key] = f"{value:.2f}"
+            if key == "bitmap_cvg":
+                merged[key] += "%"
+    merged["instances"] = str(len(stats_ls))
+    return merged
+
+
+def read_run_stats(path: str | Path) -> dict[str, str] | None:
+    # the fuzzer_stats of all instances of one run, merged
+    stats_ls = []
+    for fuzzer_stats_path in get_item_paths(path, "fuzzer_stats"):
+        try:
+            stats_ls.append(read_fuzzer_stats(fuzzer_stats_path))
+        except OSError:
+            continue
+    if not stats_ls:
+        return None
+    return merge_fuzzer_stats(stats_ls)
+
+
 VULNERABILITY_SEVERITY = {
     "EXPLOITABLE": (
         "SegFaultOnPc",
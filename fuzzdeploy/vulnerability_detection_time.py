@@ -8,7 +8,9 @@ from styleframe import StyleFrame, Styler, utils
 
 from .utils import (
     VULNERABILITY_SEVERITY,
-    get_item_path,
+    get_crash_instance,
+    get_instance_name,
+    get_item_paths,
     is_heap_related_vulnerability,
     work_dir_iterdir,
 )
@@ -36,12 +38,12 @@ def get(work_dir: str | Path):
     res = []
     for item in work_dir_iterdir(work_dir, "casr"):
         archive_path = item.work_dir / "archive" / item.fuzzer / item.target / item.idx
-        plot_data_path = get_item_path(
-            archive_path,
-            "plot_data",
-        )
-        assert plot_data_path, f"{archive_path} plot_data not found"
-        plot_data = get_plot_data(plot_data_path)
+        # crash ids count per instance, so are the crashes in plot_data
+        plot_data_ls = {}
+        for plot_data_path in get_item_paths(archive_path, "plot_data"):
+            instance = get_instance_name(archive_path, plot_data_path)
+            plot_data_ls[instance] = get_plot_data(plot_data_path)
+        assert plot_data_ls, f"{archive_path} plot_data not found"
         reports_unique_line_path = (
             item.work_dir
             / "casr"
@@ -67,6 +69,11 @@ def get(work_dir: str | Path):
             vul_type = json_data["CrashSeverity"]["ShortDescription"]
             crash_line = json_data["CrashLine"].split("/")[-1]
             id = int(report.name.split(",")[0].lstrip("id:")) + 1
+            instance = get_crash_instance(report.name.removesuffix(".casrep"))
+            assert (
+                instance in plot_data_ls
+            ), f"{archive_path} plot_data of instance {instance} not found"
+            plot_data = plot_data_ls[instance]
             # print("plot_data_path\n", plot_data_path)
             # print("report\n", report)
             # print("plot_data\n", plot_data)
@@ -0,0 +1,24 @@
+#!/bin/bash
+# runs the items queued in $JOBS one after another, see make.make(pool=True)
+# a job file holds <fuzzer>/<target>/<idx> of one archive item
+
+while true; do
+    job=$(find "$JOBS" -maxdepth 1 -name "*.job" | sort | head -n 1)
+    if [ -z "$job" ]; then
+        if [ -e "$JOBS/closed" ]; then
+            break
+        fi
+        sleep 1
+        continue
+    fi
+    claimed="${job%.job}.$WORKER"
+    # another worker was faster
+    mv "$job" "$claimed" 2>/dev/null || continue
+    item=$(cat "$claimed")
+    export ITEM="$item"
+    export SHARED="$WORK/archive/$item"
+    export DST="$WORK/$SUB_DIR/$item"
+    mkdir -p "$DST"
+    bash "$RUN_SCRIPT" || echo "$item failed with $?"
+    mv "$claimed" "${job%.job}.done"
+done
@@ -9,5 +9,5 @@ export AFL_IGNORE_UNKNOWN_ENVS=1
 
 cd "$PROGRAM"
 "$FUZZER/repo/afl-fuzz" -m none -t 2000+ \
-    -i "$TARGET/corpus" -o "$SHARED" \
+    -i "$CORPUS" -o "$SHARED" \
     $FUZZER_ARGS -- $TAEGET_ARGS
@@ -5,7 +5,7 @@ export DEBIAN_FRONTEND=noninteractive
 
 apt-get update
 apt-get install -y \
-    sudo tmux htop git wget \
+    sudo tmux htop git wget python3 \
     make build-essential gcc-7-plugin-dev gnupg \
     lsb-release software-properties-common
 
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# triages the crashes of $SHARED into $DST, see run.sh
+# runs with the python3 of the casr image, keep it 3.6 compatible
+import hashlib
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+# seconds casr-san waits for the target to crash
+CASR_TIMEOUT = 10
+# seconds before a hanging casr-san is killed, symbolization included
+CRASH_TIMEOUT = 120
+
+
+# the reports of $DST/reports that are clustered already, one per line
+CLUSTERED_NAME = "clustered"
+# the triage ledger of the work_dir in $STORE
+LEDGER_NAME = "ledger.jsonl"
+
+
+def get_jobs():
+    # the cpuset of the run, make() grows and shrinks it while triaging
+    return max(1, len(os.sched_getaffinity(0)))
+
+
+def get_crashes(shared):
+    crashes_dirs = []
+    for p in sorted(shared.glob("*")):
+        if p.name == "crashes" and p.is_dir():
+            crashes_dirs.append(p)
+    for p in sorted(shared.glob("*/crashes")):
+        if p.is_dir():
+            crashes_dirs.append(p)
+    crashes = {}
+    for crashes_dir in crashes_dirs:
+        # crash ids restart in every -M/-S instance, keep the reports apart
+        instance = crashes_dir.parent
+        suffix = ""
+        if instance != shared and instance.name != "default":
+            suffix = f",instance:{instance.name}"
+        for p in sorted(crashes_dir.glob("id*")):
+            if p.is_file():
+                crashes[p.name + suffix] = p
+    return crashes_dirs, crashes
+
+
+def get_command(target_args, crash, report):
+    command = ["casr-san", "-t", str(CASR_TIMEOUT), "-o", report.as_posix()]
+    if "@@" in target_args:
+        return (
+            command
+            + ["--"]
+            + [_.replace("@@", crash.as_posix()) for _ in target_args.split()]
+        )
+    return command + ["--stdin", crash.as_posix(), "--"] + target_args.split()
+
+
+def get_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def put_file(src, dst):
+    # a hard link where possible, the store and $DST may be different mounts
+    try:
+        os.link(src, dst)
+    except OSError:
+        tmp = dst.with_name(f".{dst.name}.{os.getpid()}")
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+
+
+class Store:
+    # the results by the content of the crash, shared by the runs of all
+    # fuzzers on the target, $STORE/<target>/<digest>.casrep or .failed
+    def __init__(self, path):
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, digest):
+        for status, suffix in (("reported", ".casrep"), ("failed", ".failed")):
+            p = self.path / f"{digest}{suffix}"
+            if p.exists():
+                return status, p
+        return None
+
+    def claim(self, digest):
+        # whether this triage runs casr-san on the content, a run of another
+        # fuzzer may be at it already
+        claim = self.path / f"{digest}.claim"
+        for _ in range(2):
+            try:
+                os.close(os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                pass
+            # left behind by a killed triage, casr-san never runs that long
+            try:
+                if time.time() - claim.stat().st_mtime < 2 * CRASH_TIMEOUT:
+                    return False
+                claim.unlink()
+            except FileNotFoundError:
+                pass
+        return False
+
+    def put(self, digest, status, src):
+        suffix = ".casrep" if status == "reported" else ".failed"
+        put_file(src, self.path / f"{digest}{suffix}")
+        self.release(digest)
+
+    def release(self, digest):
+        try:
+            (self.path / f"{digest}.claim").unlink()
+        except FileNotFoundError:
+            pass
+
+
+class Run(NamedTuple):
+    process: subprocess.Popen
+    digest: str
+    # byte-identical crashes, casr-san runs on the first one only
+    crashes: list
+    report: Path
+    stderr: Path
+    started: float
+
+
+class Progress:
+    # one json object per line, the host follows the file while triaging
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def emit(self, **event):
+        event["time"] = round(time.time(), 3)
+        self.file.write(json.dumps(event) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Ledger:
+    # the crash states of the work_dir, see fuzzdeploy/triage.py
+    def __init__(self, path, item):
+        self.file = open(path, "a")
+        self.item = item
+
+    def record(self, crash, state, result):
+        # one write per record, the runs of the work_dir append concurrently
+        self.file.write(
+            json.dumps(
+                {"item": self.item, "crash": crash, "state": state, "result": result}
+            )
+            + "\n"
+        )
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Triage:
+    def __init__(self, target_args, dst, store=None, ledger=None):
+        self.target_args = target_args
+        self.reports_dir = dst / "reports"
+        self.failed_dir = dst / "failed"
+        # results are renamed into reports and failed once complete
+        self.tmp_dir = dst / ".triage"
+        self.store = store
+        self.ledger = ledger
+        for p in (self.reports_dir, self.failed_dir):
+            p.mkdir(parents=True, exist_ok=True)
+        self.progress = Progress(dst / "progress.jsonl")
+        self.counts = {"reported": 0, "failed": 0, "timeout": 0, "deduplicated": 0}
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.tmp_dir.mkdir()
+
+    def get_path(self, name, status):
+        if status == "reported":
+            return self.reports_dir / f"{name}.casrep"
+        return self.failed_dir / name
+
+    def is_done(self, name):
+        return (
+            self.get_path(name, "reported").exists()
+            or self.get_path(name, "failed").exists()
+        )
+
+    def deduplicate(self, crashes, status, src):
+        for name, _ in crashes:
+            put_file(src, self.get_path(name, status))
+            self.counts["deduplicated"] += 1
+            self.progress.emit(
+                event="crash", crash=name, status="deduplicated", result=status
+            )
+            if self.ledger is not None:
+                self.ledger.record(name, "deduplicated", status)
+
+    def resolve(self, digest, crashes):
+        # the result of the same content triaged by an earlier run
+        if self.store is None:
+            return False
+        res = self.store.get(digest)
+        if res is None:
+            return False
+        self.deduplicate(crashes, *res)
+        return True
+
+    def start(self, n, digest, crashes):
+        report = self.tmp_dir / f"{n}.casrep"
+        stderr = self.tmp_dir / f"{n}.stderr"
+        # stderr is kept from the first run, it is only needed on failure
+        with open(stderr, "wb") as f:
+            process = subprocess.Popen(
+                get_command(self.target_args, crashes[0][1], report),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=f,
+                start_new_session=True,
+            )
+        return Run(process, digest, crashes, report, stderr, time.monotonic())
+
+    def finish(self, run, timeout=False):
+        process, digest, crashes, report, stderr, started = run
+        name = crashes[0][0]
+        if timeout:
+            # the target runs in the session of casr-san
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            with open(stderr, "a") as f:
+                f.write(f"\ncasr-san timed out after {CRASH_TIMEOUT}s\n")
+            status = "timeout"
+        elif process.returncode == 0 and report.exists():
+            status = "reported"
+        else:
+            status = "failed"
+        path = self.get_path(name, status)
+        if status == "reported":
+            os.replace(report, path)
+            stderr.unlink()
+        else:
+            os.replace(stderr, path)
+            if report.exists():
+                report.unlink()
+        self.counts[status] += 1
+        self.progress.emit(
+            event="crash",
+            crash=name,
+            status=status,
+            code=process.returncode,
+            seconds=round(time.monotonic() - started, 3),
+        )
+        if self.store is not None:
+            if status == "timeout":
+                # a loaded host is no result, other runs try again
+                self.store.release(digest)
+            else:
+                self.store.put(digest, status, path)
+        if status == "timeout":
+            status = "failed"
+        if self.ledger is not None:
+            self.ledger.record(name, status, status)
+        self.deduplicate(crashes[1:], status, path)
+
+    def run(self, crashes):
+        todo = [(name, p) for name, p in crashes.items() if not self.is_done(name)]
+        self.progress.emit(
+            event="start", total=len(crashes), todo=len(todo), jobs=get_jobs()
+        )
+        groups = {}
+        for name, p in todo:
+            groups.setdefault(get_digest(p), []).append((name, p))
+        pending = list(groups.items())
+        pending.reverse()
+        # claimed by the triage of another run
+        deferred = []
+        running = []
+        n = 0
+        while pending or deferred or running:
+            for digest, group in list(deferred):
+                if self.resolve(digest, group):
+                    deferred.remove((digest, group))
+                elif len(running) < get_jobs() and self.store.claim(digest):
+                    deferred.remove((digest, group))
+                    running.append(self.start(n, digest, group))
+                    n += 1
+            while pending and len(running) < get_jobs():
+                digest, group = pending.pop()
+                if self.resolve(digest, group):
+                    continue
+                if self.store is not None and not self.store.claim(digest):
+                    deferred.append((digest, group))
+                    continue
+                running.append(self.start(n, digest, group))
+                n += 1
+            time.sleep(0.05)
+            for run in list(running):
+                if run.process.poll() is not None:
+                    self.finish(run)
+                elif time.monotonic() - run.started > CRASH_TIMEOUT:
+                    self.finish(run, timeout=True)
+                else:
+                    continue
+                running.remove(run)
+        self.progress.emit(event="end", **self.counts)
+        self.progress.close()
+        if self.ledger is not None:
+            self.ledger.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class ClusterError(Exception):
+    pass
+
+
+def call(args, **kwargs):
+    code = subprocess.call(args, **kwargs)
+    if code != 0:
+        raise ClusterError(f"{' '.join(map(str, args))} exited with {code}")
+
+
+def get_crash_line(report):
+    try:
+        with open(report) as f:
+            crash_line = json.load(f).get("CrashLine")
+    except (OSError, ValueError):
+        crash_line = None
+    # a report without a crash line is unique on its own
+    return crash_line or report.name
+
+
+class Cluster:
+    # deduplicates and clusters the new reports only, the reports of an
+    # earlier triage keep their clusters
+    def __init__(self, dst):
+        self.reports_dir = dst / "reports"
+        self.dedup_dir = dst / "reports_dedup"
+        self.cluster_dir = dst / "reports_dedup_cluster"
+        self.unique_line_dir = dst / "reports_unique_line"
+        self.summary_path = dst / "summary_by_unique_line"
+        self.clustered_path = dst / CLUSTERED_NAME
+        self.tmp_dir = dst / ".cluster"
+
+    def get_clustered(self):
+        if not self.clustered_path.exists() or not self.cluster_dir.is_dir():
+            return None
+        return set(self.clustered_path.read_text().splitlines())
+
+    def reset(self):
+        for p in (
+            self.dedup_dir,
+            self.cluster_dir,
+            self.unique_line_dir,
+            self.summary_path,
+            self.clustered_path,
+        ):
+            if p.is_dir():
+                shutil.rmtree(p)
+            elif p.exists():
+                p.unlink()
+
+    def run(self):
+        reports = sorted(self.reports_dir.glob("*.casrep"))
+        clustered = self.get_clustered()
+        if clustered is not None:
+            new = [p for p in reports if p.name not in clustered]
+            if not new and self.summary_path.exists():
+                return 0
+            try:
+                return self.update(reports, new, incremental=True)
+            except ClusterError as e:
+                print(f"{e}, clustering all reports again")
+        self.reset()
+        return self.update(reports, reports, incremental=False)
+
+    def update(self, reports, new, incremental):
+        # the record of the clustered reports is written last, a failed
+        # step leaves the clusters to be recomputed next time
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        new_dir = self.tmp_dir / "new"
+        new_dir.mkdir(parents=True)
+        for p in new:
+            os.link(p, new_dir / p.name)
+        dedup_dir = new_dir
+        if len(new) > 1:
+            dedup_dir = self.tmp_dir / "dedup"
+            call(["casr-cluster", "-d", new_dir, dedup_dir])
+        if incremental:
+            # the new reports whose stack trace is not deduplicated yet
+            diff_dir = self.tmp_dir / "diff"
+            call(["casr-cluster", "--diff", dedup_dir, self.dedup_dir, diff_dir])
+            diff_dir.mkdir(exist_ok=True)
+        else:
+            diff_dir = dedup_dir
+        unique = sorted(diff_dir.glob("*.casrep"))
+        if incremental and unique:
+            # adds to the closest cluster or opens a new one
+            call(["casr-cluster", "-u", diff_dir, self.cluster_dir])
+        self.dedup_dir.mkdir(exist_ok=True)
+        for p in unique:
+            shutil.copy2(p, self.dedup_dir / p.name)
+        # casr-cluster can not cluster a single report
+        if not incremental and len(unique) > 1:
+            call(["casr-cluster", "-c", self.dedup_dir, self.cluster_dir])
+        # one report per crash line, the summary is made of them only
+        self.unique_line_dir.mkdir(exist_ok=True)
+        crash_lines = set()
+        for p in self.unique_line_dir.glob("*.casrep"):
+            crash_lines.add(get_crash_line(p))
+        for p in unique:
+            crash_line = get_crash_line(p)
+            if crash_line not in crash_lines:
+                crash_lines.add(crash_line)
+                shutil.copy2(p, self.unique_line_dir / p.name)
+        with open(self.summary_path.with_name(".summary"), "w") as f:
+            if crash_lines:
+                call(["casr-cli", "-u", self.unique_line_dir], stdout=f)
+        os.replace(self.summary_path.with_name(".summary"), self.summary_path)
+        with open(self.clustered_path.with_name(".clustered"), "w") as f:
+            f.write("".join(f"{p.name}\n" for p in reports))
+        os.replace(self.clustered_path.with_name(".clustered"), self.clustered_path)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        return len(unique)
+
+
+def main():
+    shared = Path(os.environ["SHARED"])
+    dst = Path(os.environ["DST"])
+    target_args = "{}/{}".format(
+        os.environ["PROGRAM"],
+        (Path(os.environ["TARGET"]) / "target_args").read_text().strip(),
+    )
+    crashes_dirs, crashes = get_crashes(shared)
+    if not crashes_dirs:
+        print("Error: crashes_dir not found")
+        return 1
+    store = ledger = None
+    if os.environ.get("STORE"):
+        store = Store(Path(os.environ["STORE"]) / os.environ["TARGET_NAME"])
+        if os.environ.get("ITEM"):
+            ledger = Ledger(Path(os.environ["STORE"]) / LEDGER_NAME, os.environ["ITEM"])
+    triage = Triage(target_args, dst, store, ledger)
+    triage.run(crashes)
+    print(" ".join(f"{k}: {v}" for k, v in triage.counts.items()))
+    try:
+        print(f"unique: {Cluster(dst).run()}")
+    except ClusterError as e:
+        print(e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
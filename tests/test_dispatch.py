@@ -0,0 +1,210 @@
+import json
+import shutil
+import signal
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from fuzzdeploy import make as make_module
+from fuzzdeploy.backend import ProcessHost, RunSpec
+from fuzzdeploy.deploy import fuzzing
+from fuzzdeploy.make import make
+from fuzzdeploy.scheduler import ContainerScheduler
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("taskset") is None or shutil.which("timeout") is None,
+    reason="needs taskset and timeout",
+)
+
+
+def write_script(path: Path, body: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("#!/bin/bash\nset -e\n" + body)
+
+
+@pytest.fixture(autouse=True)
+def sigint_handler():
+    # fuzzing() installs its own handler
+    handler = signal.getsignal(signal.SIGINT)
+    yield
+    signal.signal(signal.SIGINT, handler)
+
+
+@pytest.fixture
+def native_dir(tmp_path: Path) -> Path:
+    # native builds laid out like the images, see backend.ProcessHost
+    native_dir = tmp_path / "native"
+    for fuzzer in ("f", "triage"):
+        root = native_dir / fuzzer / "t"
+        (root / "program").mkdir(parents=True)
+        (root / "src" / "target" / "corpus").mkdir(parents=True)
+        (root / "src" / "target" / "target_args").write_text("prog @@\n")
+    # a fuzzer that runs until its timeout
+    write_script(
+        native_dir / "f" / "t" / "src" / "fuzzer" / "run.sh",
+        'date +%s.%N > "$SHARED/started"\nsleep 60\n',
+    )
+    return native_dir
+
+
+def get_runs(work_dir: Path) -> list[dict]:
+    with open(work_dir / "campaign.json", "r") as f:
+        return json.load(f)["runs"]
+
+
+def get_started(work_dir: Path) -> list[float]:
+    return sorted(
+        float(p.read_text()) for p in (work_dir / "archive").glob("f/t/*/started")
+    )
+
+
+def test_fuzzing_reuses_slot(tmp_path: Path, native_dir: Path):
+    work_dir = tmp_path / "work"
+    fuzzing(
+        work_dir,
+        ["f"],
+        ["t"],
+        "1s",
+        repeat=3,
+        hosts=[ProcessHost(native_dir, cpu_range=[0])],
+    )
+    runs = get_runs(work_dir)
+    assert sorted(run["idx"] for run in runs) == ["1", "2", "3"]
+    assert all(run["status"] == "finished" for run in runs)
+    # one slot, the runs followed each other, a run starts a moment after
+    # its timeout does
+    started = get_started(work_dir)
+    assert len(started) == 3
+    assert started[1] - started[0] >= 0.5 and started[2] - started[1] >= 0.5
+
+
+def test_fuzzing_spreads_over_hosts(tmp_path: Path, native_dir: Path):
+    work_dir = tmp_path / "work"
+    fuzzing(
+        work_dir,
+        ["f"],
+        ["t"],
+        "2s",
+        repeat=2,
+        hosts=[
+            ProcessHost(native_dir, cpu_range=[0]),
+            ProcessHost(native_dir, cpu_range=[0]),
+        ],
+    )
+    assert all(run["status"] == "finished" for run in get_runs(work_dir))
+    # one slot per host, the second run did not wait for the first
+    started = get_started(work_dir)
+    assert len(started) == 2
+    assert started[1] - started[0] < 2
+
+
+def test_fuzzing_keeps_failed_run_interrupted(tmp_path: Path, native_dir: Path):
+    work_dir = tmp_path / "work"
+    write_script(native_dir / "f" / "t" / "src" / "fuzzer" / "run.sh", "exit 1\n")
+    fuzzing(work_dir, ["f"], ["t"], "1h", hosts=[ProcessHost(native_dir)])
+    assert [run["status"] for run in get_runs(work_dir)] == ["interrupted"]
+
+
+@pytest.mark.parametrize("pool", [False, True])
+def test_make(tmp_path: Path, native_dir: Path, monkeypatch, pool: bool):
+    work_dir = tmp_path / "work"
+    for idx in ("1", "2", "3"):
+        (work_dir / "archive" / "f" / "t" / idx).mkdir(parents=True)
+    fuzzers_dir = tmp_path / "fuzzers"
+    write_script(fuzzers_dir / "triage" / "run.sh", 'echo "$ITEM" > "$DST/done"\n')
+    monkeypatch.setattr(make_module, "FUZZERS_DIR", fuzzers_dir)
+    make(
+        work_dir=work_dir,
+        sub_dir="triage",
+        base_image="triage",
+        hosts=[ProcessHost(native_dir, cpu_range=[0])],
+        pool=pool,
+    )
+    for idx in ("1", "2", "3"):
+        done = work_dir / "triage" / "f" / "t" / idx / "done"
+        assert done.read_text() == f"f/t/{idx}\n"
+
+
+def test_exit_before_register(tmp_path: Path, native_dir: Path):
+    # reconcile would pick the exit up only after a minute
+    backend = ProcessHost(native_dir).get_backend(reconcile_interval=60)
+    released = []
+    backend.on_release.append(released.append)
+    script = tmp_path / "exit.sh"
+    write_script(script, "exit 0\n")
+    slots = backend.acquire()
+    run = backend.launch(
+        RunSpec(
+            name="exit",
+            fuzzer="f",
+            target="t",
+            script=script,
+            cpuset=",".join(slots),
+            volumes={},
+            environment={},
+            labels={},
+        )
+    )
+    run.process.wait()
+    time.sleep(0.5)
+    # the exit is seen before the run is registered
+    backend.wait_exited()
+    assert not released
+    backend.register(run, slots)
+    waiter = threading.Thread(target=backend.wait, daemon=True)
+    waiter.start()
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert released == [run]
+    assert backend.free_slots == slots
+
+
+class FakeContainer:
+    def __init__(self, container_id: str):
+        self.id = container_id
+        self.status = "running"
+
+    def reload(self):
+        pass
+
+
+class FakeEvents:
+    def __init__(self, events: list[dict]):
+        self.events = events
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    # what ContainerScheduler needs of a DockerSession, the events are
+    # replayed as the daemon would send them
+    def __init__(self, events: list[dict]):
+        self.client = SimpleNamespace(events=lambda **kwargs: FakeEvents(events))
+        self.removed = []
+
+    def remove_container(self, container, force: bool = False):
+        self.removed.append(container.id)
+
+
+def test_oom_keeps_container():
+    # the target child of afl-fuzz was killed, afl-fuzz itself runs on
+    session = FakeSession([{"Action": "oom", "id": "c1"}])
+    scheduler = ContainerScheduler(session, [["0"]], reconcile_interval=1)
+    container = FakeContainer("c1")
+    scheduler.register(container, scheduler.acquire())
+    scheduler.start()
+    time.sleep(0.5)
+    scheduler.wait_exited()
+    assert "c1" in scheduler.containers
+    assert scheduler.free_slots == [] and session.removed == []
+    # it is released once it exits
+    container.status = "exited"
+    scheduler.wait()
+    assert scheduler.free_slots == ["0"] and session.removed == ["c1"]
@@ -0,0 +1,112 @@
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from fuzzdeploy.sources import SourceCache, get_source
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+
+
+def git(*args, cwd: Path) -> str:
+    return subprocess.check_output(["git", *args], cwd=cwd, text=True).strip()
+
+
+def commit(repo: Path, name: str, content: str) -> str:
+    (repo / name).write_text(content)
+    git("add", name, cwd=repo)
+    git(
+        "-c",
+        "user.name=fuzzdeploy",
+        "-c",
+        "user.email=fuzzdeploy@localhost",
+        "commit",
+        "-q",
+        "-m",
+        name,
+        cwd=repo,
+    )
+    return git("rev-parse", "HEAD", cwd=repo)
+
+
+@pytest.fixture
+def target(tmp_path: Path) -> Path:
+    # a target whose fetch.sh clones a local repo, laid out like targets/<t>
+    upstream = tmp_path / "upstream"
+    upstream.mkdir()
+    git("init", "-q", cwd=upstream)
+    rev = commit(upstream, "main.c", "int main() { return 0; }\n")
+    target = tmp_path / "targets" / "t"
+    target.mkdir(parents=True)
+    (target / "fetch.sh").write_text(
+        "#!/bin/bash\n"
+        "set -e\n"
+        'if [ -d "$TARGET/repo" ]; then\n'
+        "    exit 0\n"
+        "fi\n"
+        f'git clone -q file://{upstream} "$TARGET/repo"\n'
+        f'git -C "$TARGET/repo" checkout -q {rev}\n'
+    )
+    return target
+
+
+def test_fetch_once(tmp_path: Path, target: Path):
+    cache = SourceCache(path=tmp_path / "cache")
+    ok, repo = get_source(cache, target, "TARGET", tmp_path / "fetch1.log")
+    assert ok and repo is not None
+    assert (repo / "main.c").exists()
+    # the upstream is gone, the second build is served from the cache
+    shutil.rmtree(tmp_path / "upstream")
+    assert get_source(cache, target, "TARGET", tmp_path / "fetch2.log") == (
+        True,
+        repo,
+    )
+    assert not (tmp_path / "fetch2.log").exists()
+
+
+def test_verify_mismatch(tmp_path: Path, target: Path):
+    cache = SourceCache(path=tmp_path / "cache", verify=True)
+    _, repo = get_source(cache, target, "TARGET", tmp_path / "fetch1.log")
+    (repo / "main.c").write_text("changed\n")
+    # offline there is nothing to replace the changed source with
+    assert get_source(
+        cache._replace(offline=True), target, "TARGET", tmp_path / "fetch2.log"
+    ) == (False, None)
+    ok, repo = get_source(cache, target, "TARGET", tmp_path / "fetch3.log")
+    assert ok and repo is not None
+    assert (repo / "main.c").read_text() == "int main() { return 0; }\n"
+
+
+def test_offline_miss(tmp_path: Path, target: Path):
+    cache = SourceCache(path=tmp_path / "cache", offline=True)
+    assert get_source(cache, target, "TARGET", tmp_path / "fetch.log") == (
+        False,
+        None,
+    )
+    assert not (tmp_path / "fetch.log").exists()
+
+
+def test_unpinned_follows_upstream(tmp_path: Path):
+    # a fetch.sh like the ones of the fuzzers, a shallow clone of the head
+    upstream = tmp_path / "upstream"
+    upstream.mkdir()
+    git("init", "-q", cwd=upstream)
+    commit(upstream, "main.c", "v1\n")
+    fuzzer = tmp_path / "fuzzers" / "f"
+    fuzzer.mkdir(parents=True)
+    (fuzzer / "fetch.sh").write_text(
+        "#!/bin/bash\n"
+        "set -e\n"
+        f'git clone -q --depth 1 file://{upstream} "$FUZZER/repo"\n'
+    )
+    cache = SourceCache(path=tmp_path / "cache")
+    _, repo = get_source(cache, fuzzer, "FUZZER", tmp_path / "fetch1.log")
+    assert repo is not None and (repo / "main.c").read_text() == "v1\n"
+    commit(upstream, "main.c", "v2\n")
+    _, repo = get_source(cache, fuzzer, "FUZZER", tmp_path / "fetch2.log")
+    assert repo is not None and (repo / "main.c").read_text() == "v2\n"
+    # offline the heads are unknown, the last fetch is used
+    assert get_source(
+        cache._replace(offline=True), fuzzer, "FUZZER", tmp_path / "fetch3.log"
+    ) == (True, repo)